@@ -0,0 +1,387 @@
+"""
+Benchmarks of the hot paths in this repo, on synthetic data and CPU only.
+
+    python benchmarks.py run --output results.json [--filter envelope] [--repeats 7]
+    python benchmarks.py compare baseline.json results.json [--threshold 0.25]
+
+'run' writes one JSON entry per benchmark with the min, median and mean wall time of 'repeats' timed calls.
+'compare' exits with status 1 if a tracked benchmark got slower than (1 + threshold) times its baseline,
+or if it is missing from or failed in the current results.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from time import perf_counter
+
+import numpy as np
+
+BENCHMARKS = {}
+
+
+def benchmark(name, number=1, tracked=True, threshold=None, **params):
+    """
+    Registers a benchmark. The decorated function gets a scratch directory and the params, does its setup,
+    and returns a callable that is timed.
+
+    Args:
+        name (str): Name of the benchmark in the results.
+        number (int): Operations per timed call, used to report the time per operation.
+        tracked (bool): Whether 'compare' fails on a regression of this benchmark.
+        threshold (float): Allowed relative slowdown overriding the one given to 'compare', for noisy benchmarks.
+        params: Sizes of the synthetic data, recorded with the results.
+    """
+    def register(setup):
+        BENCHMARKS[name] = dict(setup=setup, number=number, tracked=tracked, threshold=threshold, params=params)
+        return setup
+    return register
+
+
+# Synthetic data
+
+def synthetic_audio(channels=2, num_samples=44100 * 30, sample_rate=44100, seed=0):
+    """Returns float32 audio [channels, num_samples]: decaying tone bursts over low-level noise, in [-1, 1]."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_samples) / sample_rate
+    onsets = np.sort(rng.uniform(0, t[-1], size=max(1, int(t[-1] * 4))))
+    audio = 0.05 * rng.standard_normal((channels, num_samples))
+    burst = t[:sample_rate]  # Bursts are cut after one second, when they have decayed to below -60dB
+    for onset in onsets:
+        start = int(onset * sample_rate)
+        end = min(start + len(burst), num_samples)
+        freq = rng.uniform(80, 2000)
+        audio[:, start:end] += (0.5 * np.exp(-burst * 8) * np.sin(2 * np.pi * freq * burst))[:end - start]
+    return np.clip(audio, -1, 1).astype(np.float32)
+
+
+def synthetic_file_tree(root, depth=3, fanout=4, files_per_dir=16, exts=('.wav', '.npy', '.txt')):
+    """Creates empty files in a tree of fanout ** depth leaf directories. Returns the number of files."""
+    count = 0
+    dirs = [root]
+    for level in range(depth + 1):
+        next_dirs = []
+        for d in dirs:
+            os.makedirs(d, exist_ok=True)
+            for i in range(files_per_dir):
+                open(os.path.join(d, f'file_{i}{exts[i % len(exts)]}'), 'w').close()
+                count += 1
+            if level < depth:
+                next_dirs += [os.path.join(d, f'dir_{j}') for j in range(fanout)]
+        dirs = next_dirs
+    return count
+
+
+def synthetic_metric_stream(variable_names, num_steps, seed=0):
+    """Returns a list of num_steps {name: value} dicts, noisy decaying curves as in a training log."""
+    rng = np.random.default_rng(seed)
+    steps = np.arange(1, num_steps + 1)
+    values = {name: np.exp(-steps / (num_steps / (i + 1))) + 0.05 * rng.standard_normal(num_steps)
+              for i, name in enumerate(variable_names)}
+    return [{name: float(values[name][s]) for name in variable_names} for s in range(num_steps)]
+
+
+class _StandInUtils:
+    """Spectrogram and batched encoder calls as in musika.utils.Utils_functions, without the musika package."""
+    def __init__(self, args):
+        self.args = args
+
+    def wv2spec(self, wv, hop_size=256):
+        import tensorflow as tf
+        X = tf.signal.stft(wv, frame_length=4 * hop_size, frame_step=hop_size, fft_length=4 * hop_size, pad_end=False)
+        return tf.math.log(tf.abs(X)[:, :self.args.bins] + 1e-5)
+
+    def distribute_enc(self, x, model, bs=64):
+        import tensorflow as tf
+        return tf.concat([model(x[i:i + bs], training=False) for i in range(0, x.shape[0], bs)], 0)
+
+
+def _stand_in_encoder(compression, depth):
+    """Encoder stand-in mapping [B, H, W, C] to [B, 1, W // compression, depth] with one reshape and mean."""
+    import tensorflow as tf
+
+    def encode(x, training=False):
+        b, h, w, c = x.shape
+        x = tf.reshape(x, [b, h, w // compression, compression * c])
+        x = tf.reduce_mean(x, axis=1, keepdims=True)
+        return x[..., :depth] if compression * c >= depth else tf.tile(x, [1, 1, 1, depth // (compression * c)])
+    return encode
+
+
+def stand_in_musika(hop=256, shape=128, bins=256, depth=64):
+    """MusikaEncoderDecoder with stand-in encoders, built without musika.utils or trained weights."""
+    from types import SimpleNamespace
+    from tmp_musika import MusikaEncoderDecoder
+
+    musika = MusikaEncoderDecoder.__new__(MusikaEncoderDecoder)
+    musika.args = SimpleNamespace(hop=hop, shape=shape, bins=bins)
+    musika.U = _StandInUtils(musika.args)
+    musika.enc = _stand_in_encoder(compression=4, depth=depth)
+    musika.enc2 = _stand_in_encoder(compression=8, depth=depth)
+    musika.time_compression_ratio = None
+    musika.stage1_latent_frames = None
+    return musika
+
+
+# Benchmarks
+
+@benchmark('envelope.pooling', channels=2, num_samples=44100 * 60, k=201)
+def bench_envelope_pooling(workdir, channels, num_samples, k):
+    import torch
+    from audio_envelope import compute_envelope
+    torch.set_num_threads(1)
+    x = torch.from_numpy(synthetic_audio(channels, num_samples))[:, None]
+    return lambda: compute_envelope(None, x, k)
+
+
+@benchmark('envelope.fast', channels=2, num_samples=44100 * 60, k=201)
+def bench_envelope_fast(workdir, channels, num_samples, k):
+    from audio_envelope import compute_envelope_fast
+    x = synthetic_audio(channels, num_samples)
+    return lambda: compute_envelope_fast(x, k)
+
+
+@benchmark('envelope.stream', channels=2, num_samples=44100 * 60, k=201, block_size=2**18)
+def bench_envelope_stream(workdir, channels, num_samples, k, block_size):
+    from audio_envelope import stream_envelope
+    path = os.path.join(workdir, 'audio.npy')
+    np.save(path, synthetic_audio(channels, num_samples))
+
+    def run():
+        for _ in stream_envelope(path, k, block_size):
+            pass
+    return run
+
+
+@benchmark('envelope_cache.store', number=64, threshold=0.5, num_files=64, envelope_samples=44100 * 10)
+def bench_envelope_cache_store(workdir, num_files, envelope_samples):
+    from audio_envelope import EnvelopeCache
+    files = _touch_files(workdir, num_files)
+    envelope = synthetic_audio(2, envelope_samples)
+    cache = EnvelopeCache(os.path.join(workdir, 'cache'), memory_items=0)
+
+    def run():
+        for path in files:
+            cache.store(path, 201, envelope)
+    return run
+
+
+@benchmark('envelope_cache.load', number=64, num_files=64, envelope_samples=44100 * 10)
+def bench_envelope_cache_load(workdir, num_files, envelope_samples):
+    from audio_envelope import EnvelopeCache
+    files = _touch_files(workdir, num_files)
+    envelope = synthetic_audio(2, envelope_samples)
+    # Disk hits only: the memory tier would turn every call after the first into a dictionary lookup
+    cache = EnvelopeCache(os.path.join(workdir, 'cache'), memory_items=0, mmap_mode=None)
+    for path in files:
+        cache.store(path, 201, envelope)
+
+    def run():
+        for path in files:
+            cache.load(path, 201)
+    return run
+
+
+@benchmark('meters.update', number=20000, num_steps=20000, num_variables=8)
+def bench_meters_update(workdir, num_steps, num_variables):
+    from utils import Meters
+    names = [f'metric_{i}' for i in range(num_variables)]
+    stream = synthetic_metric_stream(names, num_steps)
+
+    def run():
+        meters = Meters(names)
+        for data in stream:
+            meters.update(data)
+    return run
+
+
+@benchmark('meters.mean', number=10000, num_steps=100000, num_variables=8)
+def bench_meters_mean(workdir, num_steps, num_variables):
+    from utils import Meters
+    names = [f'metric_{i}' for i in range(num_variables)]
+    meters = Meters(names)
+    for data in synthetic_metric_stream(names, num_steps):
+        meters.update(data)
+    calls = 10000 // num_variables
+
+    def run():
+        for _ in range(calls):
+            for name in names:
+                meters.mean(name)
+    return run
+
+
+@benchmark('custom_logger.log_routing', number=20000, num_records=20000, num_files=8)
+def bench_logger_routing(workdir, num_records, num_files):
+    from custom_logger import CustomLogger
+    logger = CustomLogger('benchmark', os.path.join(workdir, 'default.log'), level=logging.INFO)
+    logger.remove_stream_handler()
+    targets = [os.path.join(workdir, f'log_{i}.log') for i in range(num_files)] + [None]
+
+    def run():
+        for i in range(num_records):
+            logger.log(logging.INFO, 'step %d loss %.4f', targets[i % len(targets)], i, 0.5)
+    return run
+
+
+@benchmark('list_files_deep', depth=4, fanout=4, files_per_dir=16)
+def bench_list_files_deep(workdir, depth, fanout, files_per_dir):
+    from utils import list_files_deep
+    root = os.path.join(workdir, 'tree')
+    synthetic_file_tree(root, depth, fanout, files_per_dir)
+    return lambda: list_files_deep(root, filter_ext=['.wav', '.npy'])
+
+
+@benchmark('profiler.tick', number=100000, num_ticks=100000, num_messages=8)
+def bench_profiler_tick(workdir, num_ticks, num_messages):
+    from utils import Profiler
+    messages = [f'stage_{i}' for i in range(num_messages)]
+
+    def run():
+        profiler = Profiler()
+        for i in range(num_ticks):
+            profiler.tick(messages[i % num_messages])
+    return run
+
+
+@benchmark('musika.encode_audio', channels=2, num_samples=44100 * 60)
+def bench_musika_encode_audio(workdir, channels, num_samples):
+    musika = stand_in_musika()
+    audio = synthetic_audio(channels, num_samples)
+    return lambda: musika.encode_audio(audio)
+
+
+def _touch_files(workdir, num_files):
+    files = [os.path.join(workdir, f'audio_{i}.wav') for i in range(num_files)]
+    for path in files:
+        with open(path, 'wb') as f:
+            f.write(os.urandom(64))
+    return files
+
+
+# Runner and comparison
+
+def run_benchmark(name, repeats=5, warmup=1):
+    """
+    Sets up and times one benchmark in a fresh scratch directory.
+
+    Returns:
+        result (dict): Wall times in seconds of the timed calls and the time per operation.
+    """
+    spec = BENCHMARKS[name]
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        run = spec['setup'](workdir, **spec['params'])
+        for _ in range(warmup):
+            run()
+        times = []
+        for _ in range(repeats):
+            t0 = perf_counter()
+            run()
+            times.append(perf_counter() - t0)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    times = np.array(times)
+    return dict(min_s=float(times.min()), median_s=float(np.median(times)), mean_s=float(times.mean()),
+                per_op_s=float(times.min() / spec['number']), repeats=repeats, number=spec['number'],
+                tracked=spec['tracked'], threshold=spec['threshold'], params=spec['params'])
+
+
+def run_all(pattern=None, repeats=5):
+    """
+    Runs every benchmark whose name contains 'pattern'. A benchmark that fails, including a missing
+    dependency, is recorded with its error and the remaining benchmarks still run.
+    """
+    results = {}
+    for name, spec in BENCHMARKS.items():
+        if pattern and pattern not in name:
+            continue
+        try:
+            results[name] = run_benchmark(name, repeats)
+            print(f"{name:<28} min {results[name]['min_s'] * 1000:10.2f}ms   "
+                  f"per op {results[name]['per_op_s'] * 1e6:10.2f}us")
+        except Exception as e:
+            results[name] = dict(error=repr(e), tracked=spec['tracked'], params=spec['params'])
+            print(f"{name:<28} failed: {e!r}")
+    return dict(meta=_environment(), benchmarks=results)
+
+
+def _environment():
+    return dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                numpy=np.__version__, platform=platform.platform(), cpu_count=os.cpu_count())
+
+
+def compare(baseline, current, threshold=0.25, stat='min_s'):
+    """
+    Compares two results dicts from run_all.
+
+    Args:
+        threshold (float): Allowed relative slowdown, 0.25 fails benchmarks more than 25% slower. Benchmarks
+            registered with their own threshold use that instead.
+        stat (str): Statistic compared, the minimum is the least sensitive to other load on the machine.
+
+    Returns:
+        regressions (list): Names of tracked benchmarks slower than allowed, or missing or failed in current.
+    """
+    regressions = []
+    for name, base in baseline['benchmarks'].items():
+        if stat not in base:
+            print(f"{name:<28} failed in the baseline, not compared")
+            continue
+        new = current['benchmarks'].get(name)
+        if new is None or stat not in new:
+            problem = 'missing' if new is None else f"failed: {new.get('error')}"
+            print(f"{name:<28} {problem}")
+            if base['tracked']:
+                regressions.append(name)
+            continue
+        allowed = new.get('threshold') or threshold
+        ratio = new[stat] / base[stat]
+        regressed = new['tracked'] and ratio > 1 + allowed
+        status = 'REGRESSION' if regressed else ('faster' if ratio < 1 / (1 + allowed) else 'ok')
+        print(f"{name:<28} {base[stat] * 1000:10.2f}ms -> {new[stat] * 1000:10.2f}ms  x{ratio:5.2f}  {status}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmarks and write the results as JSON')
+    run_parser.add_argument('--output', default='benchmark_results.json')
+    run_parser.add_argument('--filter', default=None, help='Only run benchmarks whose name contains this')
+    run_parser.add_argument('--repeats', type=int, default=5)
+
+    compare_parser = commands.add_parser('compare', help='Fail if a tracked benchmark regressed')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.25)
+    compare_parser.add_argument('--stat', default='min_s', choices=['min_s', 'median_s', 'mean_s'])
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        results = run_all(args.filter, args.repeats)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = compare(baseline, current, args.threshold, args.stat)
+    if regressions:
+        print(f"{len(regressions)} tracked benchmark(s) regressed, were missing or failed: "
+              f"{', '.join(regressions)}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,62 +1,366 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import monotonic
+
+class FileHandlerPool:
+    """
+    Keeps FileHandlers open across calls, keyed by path, closing the least recently used beyond max_open.
+    Handlers are borrowed with use(), and a handler in use by another thread is never closed.
+    """
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self.handlers = OrderedDict()
+        self.in_use = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def use(self, log_file):
+        with self.lock:
+            handler = self.handlers.get(log_file)
+            if handler is None:
+                handler = logging.FileHandler(log_file)
+                handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+                self.handlers[log_file] = handler
+                self._evict()
+            else:
+                self.handlers.move_to_end(log_file)
+            self.in_use[log_file] = self.in_use.get(log_file, 0) + 1
+        try:
+            yield handler
+        finally:
+            with self.lock:
+                self.in_use[log_file] -= 1
+                if not self.in_use[log_file]:
+                    del self.in_use[log_file]
+
+    def _evict(self):
+        # Busy handlers are skipped, so the pool can briefly hold more than max_open
+        for log_file in list(self.handlers):
+            if len(self.handlers) <= self.max_open:
+                return
+            if log_file not in self.in_use:
+                self.handlers.pop(log_file).close()
+
+    def close(self):
+        with self.lock:
+            while self.handlers:
+                _, handler = self.handlers.popitem()
+                handler.close()
+
+
+class RoutingFileHandler(logging.Handler):
+    """Writes each record to the file named by its 'log_to' attribute, using handlers from a FileHandlerPool."""
+    def __init__(self, default_log_file=None, max_open=16):
+        super().__init__()
+        self.default_log_file = default_log_file
+        self.pool = FileHandlerPool(max_open)
+
+    def emit(self, record):
+        log_to = getattr(record, 'log_to', None)
+        if log_to == 'terminal':
+            return
+        log_file = log_to or self.default_log_file
+        if log_file:
+            with self.pool.use(log_file) as handler:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def close(self):
+        self.pool.close()
+        super().close()
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler with an overflow policy for a bounded queue: 'block', 'drop_oldest' or 'drop_new'."""
+    def __init__(self, queue_size=10000, overflow='block'):
+        assert overflow in ['block', 'drop_oldest', 'drop_new']
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.overflow = overflow
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The queue stays in-process, so only the message arguments need resolving on the caller thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                if self.overflow == 'drop_new':
+                    self.dropped += 1
+                    return
+            try:
+                oldest = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.dropped += 1
+            if oldest is BatchingQueueListener._sentinel:
+                # Never drop the shutdown sentinel: put it back and drop this record instead
+                self.queue.put(oldest)
+                return
+
+
+class BatchingQueueListener:
+    """
+    Background thread that drains a queue into handlers in batches. A batch is written once it holds
+    'flush_every' records or its first record is 'flush_interval' seconds old, with one flush per stream.
+    """
+    _sentinel = None
+
+    def __init__(self, log_queue, handlers, flush_every=256, flush_interval=0.5):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Writes every record enqueued so far, then stops the thread."""
+        if self._thread is not None:
+            # Always block here, the sentinel must not be dropped by an overflow policy
+            self.queue.put(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+    def _monitor(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = monotonic() + self.flush_interval
+            while len(batch) < self.flush_every:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if self._sentinel in batch:
+                batch = batch[:batch.index(self._sentinel)]
+                running = False
+                # Drain what other threads enqueued before the sentinel was consumed
+                while True:
+                    try:
+                        record = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if record is not self._sentinel:
+                        batch.append(record)
+            for handler in list(self.handlers):
+                self._write_batch(handler, batch)
+
+    def _write_batch(self, handler, records):
+        if isinstance(handler, RoutingFileHandler):
+            by_file = OrderedDict()
+            for record in records:
+                log_to = getattr(record, 'log_to', None)
+                log_file = handler.default_log_file if log_to is None else log_to
+                if log_file and log_file != 'terminal':
+                    by_file.setdefault(log_file, []).append(record)
+            for log_file, file_records in by_file.items():
+                try:
+                    with handler.pool.use(log_file) as file_handler:
+                        self._write_batch(file_handler, file_records)
+                except Exception:
+                    # e.g. a log_to path in a missing directory, which must not kill the listener thread
+                    for record in file_records:
+                        handler.handleError(record)
+            return
+
+        records = [r for r in records if r.levelno >= handler.level and handler.filter(r)]
+        if not records:
+            return
+        if not isinstance(handler, logging.StreamHandler):
+            for record in records:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+            return
+        with handler.lock:
+            try:
+                if isinstance(handler, logging.FileHandler) and handler.stream is None:
+                    handler.stream = handler._open()
+                handler.stream.write(''.join(handler.format(r) + handler.terminator for r in records))
+                handler.flush()
+            except Exception:
+                handler.handleError(records[-1])
+
 
 class CustomLogger(logging.Logger):
-    def __init__(self, name, log_file=None, level=logging.NOTSET):
+    def __init__(self, name, log_file=None, level=logging.NOTSET, max_open_files=16, async_mode=False,
+                 queue_size=10000, overflow='block', flush_every=256, flush_interval=0.5):
         super().__init__(name, level)
         self.default_log_file = log_file
+        self.listener = None
+
+        # Per call site (or key) state of the rate-limited and sampled logging methods
+        self._occurrences = {}
+        self._last_logged = {}
+        self._repeats = {}
         
         # Create a stream handler to print log messages to the terminal
         self.add_stream_handler()
 
-        if self.default_log_file:
-            self.add_file_handler(self.default_log_file)
+        # Route file output per call through a pool of open handlers, so the handler list never changes
+        self.routing_handler = RoutingFileHandler(self.default_log_file, max_open=max_open_files)
+        self.addHandler(self.routing_handler)
+
+        # In async mode callers only enqueue, and a background listener writes to the handlers above
+        self.queue_handler = None
+        if async_mode:
+            self.queue_handler = BoundedQueueHandler(queue_size, overflow)
+            self.listener = BatchingQueueListener(self.queue_handler.queue, self.handlers[:], flush_every,
+                                                  flush_interval)
+            for handler in self.handlers[:]:
+                self.removeHandler(handler)
+            self.addHandler(self.queue_handler)
+            self.listener.start()
+            atexit.register(self.shutdown)
+
+    @property
+    def dropped_records(self):
+        return self.queue_handler.dropped if self.queue_handler is not None else 0
+
+    def shutdown(self):
+        """Drains pending records in async mode and closes the routed file handlers."""
+        self.flush_repeats()
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        self.routing_handler.close()
+
+    def _output_handlers(self):
+        # In async mode the handlers that actually write are owned by the listener thread
+        return self.listener.handlers if self.listener is not None else self.handlers
+
+    def _add_output_handler(self, handler):
+        if self.listener is not None:
+            self.listener.handlers.append(handler)
+        else:
+            self.addHandler(handler)
+
+    def _remove_output_handler(self, handler):
+        if self.listener is not None:
+            self.listener.handlers.remove(handler)
+        else:
+            self.removeHandler(handler)
+        handler.close()
 
     def add_file_handler(self, log_file):
         file_handler = logging.FileHandler(log_file)
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         file_handler.setFormatter(formatter)
-        self.addHandler(file_handler)
-
-    def remove_file_handler(self):
-        handlers = self.handlers[:]
-        for handler in handlers:
-            if isinstance(handler, logging.FileHandler):
-                self.removeHandler(handler)
-                handler.close()
+        self._add_output_handler(file_handler)
 
     def remove_file_handler(self):
-        handlers = self.handlers[:]
+        """Stops file output: removes added FileHandlers and the default log file. Explicit log_to still works."""
+        handlers = self._output_handlers()[:]
         for handler in handlers:
             if isinstance(handler, logging.FileHandler):
-                self.removeHandler(handler)
-                handler.close()
+                self._remove_output_handler(handler)
+        self.default_log_file = None
+        self.routing_handler.default_log_file = None
 
     def add_stream_handler(self):
         stream_handler = logging.StreamHandler()
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         stream_handler.setFormatter(formatter)
-        self.addHandler(stream_handler)
+        self._add_output_handler(stream_handler)
 
     def remove_stream_handler(self):
-        handlers = self.handlers[:]
+        handlers = self._output_handlers()[:]
         for handler in handlers:
             if isinstance(handler, logging.StreamHandler):
-                self.removeHandler(handler)
-                handler.close()
+                self._remove_output_handler(handler)
 
     def log(self, level, msg, log_to=None, *args, **kwargs):
-        if log_to == 'terminal':
-            self.remove_file_handler()
-            super().log(level, msg, *args, **kwargs)
-            self.add_file_handler(self.default_log_file)
-        elif log_to:
-            self.remove_file_handler()
-            self.add_file_handler(log_to)
-            super().log(level, msg, *args, **kwargs)
-            self.remove_file_handler()
-            self.add_file_handler(self.default_log_file)
-        else:
-            super().log(level, msg, *args, **kwargs)
+        if log_to:
+            kwargs['extra'] = dict(kwargs.get('extra') or {}, log_to=log_to)
+        super().log(level, msg, *args, **kwargs)
+
+    def log_every_n(self, n, level, msg, *args, key=None, log_to=None, **kwargs):
+        """Logs the 1st, (n+1)th, (2n+1)th, ... call from the same call site, or with the same 'key'."""
+        if not self.isEnabledFor(level):
+            return
+        if key is None:
+            frame = sys._getframe(1)
+            key = (frame.f_code, frame.f_lineno)
+        count = self._occurrences.get(key, 0)
+        self._occurrences[key] = count + 1
+        if count % n == 0:
+            self.log(level, msg, log_to, *args, **kwargs)
+
+    def log_every_t(self, seconds, level, msg, *args, key=None, log_to=None, **kwargs):
+        """Logs at most once per 'seconds' from the same call site, or with the same 'key'."""
+        if not self.isEnabledFor(level):
+            return
+        if key is None:
+            frame = sys._getframe(1)
+            key = (frame.f_code, frame.f_lineno)
+        now = monotonic()
+        last = self._last_logged.get(key)
+        if last is None or now - last >= seconds:
+            self._last_logged[key] = now
+            self.log(level, msg, log_to, *args, **kwargs)
+
+    def log_dedup(self, level, msg, *args, key=None, log_to=None, **kwargs):
+        """
+        Logs a message only if it differs from the previous one from the same call site (or 'key').
+        Suppressed repeats are reported as a single "repeated N times" line once the message changes.
+        """
+        if not self.isEnabledFor(level):
+            return
+        if key is None:
+            frame = sys._getframe(1)
+            key = (frame.f_code, frame.f_lineno)
+        # Compare the unformatted message and arguments, so repeats are never formatted
+        signature = (level, msg, args, log_to)
+        previous = self._repeats.get(key)
+        if previous is not None and _same_signature(previous[0], signature):
+            previous[1] += 1
+            return
+        self._flush_repeat(key)
+        self._repeats[key] = [signature, 0]
+        self.log(level, msg, log_to, *args, **kwargs)
+
+    def flush_repeats(self):
+        """Emits the pending "repeated N times" summaries of 'log_dedup'."""
+        for key in list(self._repeats):
+            self._flush_repeat(key)
+            del self._repeats[key]
+
+    def _flush_repeat(self, key):
+        previous = self._repeats.get(key)
+        if previous is not None and previous[1] > 0:
+            (level, msg, args, log_to), count = previous
+            # Let logging do the formatting, so a single mapping argument works as it does in 'log'
+            message = logging.LogRecord(self.name, level, '', 0, msg, args, None).getMessage()
+            self.log(level, f'{message} (repeated {count} times)', log_to)
+            previous[1] = 0
+
+
+def _same_signature(a, b):
+    # Arguments such as numpy arrays do not compare to a bool, treat those as a different message
+    try:
+        return a == b
+    except (TypeError, ValueError):
+        return False
+
 
 # USAGE:
 
@@ -69,4 +373,54 @@ class CustomLogger(logging.Logger):
 # logger.log(logging.INFO, "A different info message, should be printed to TERMINAL and LOG.txt", log_to='log.txt')
 # logger.log(logging.ERROR, "An error message, should be printed to TERMINAL and DEFAULT.log")
 
+# # Same routing, but writes happen on a background thread; call shutdown() (or exit) to drain
+
+# logger = CustomLogger('my_logger', log_file='default.log', async_mode=True, overflow='drop_oldest')
+
+# # Inside hot loops
+
+# logger.log_every_n(100, logging.INFO, "step %d, loss %.4f", step, loss)
+# logger.log_every_t(5.0, logging.INFO, "step %d", step)
+# logger.log_dedup(logging.WARNING, "NaN in batch, skipping")
+
+
+if __name__ == "__main__":
+    # Throughput of pooled routing against re-creating FileHandlers on every call, as this class used to
+    import os
+    import tempfile
+    from time import perf_counter
+
+    tmp_dir = tempfile.mkdtemp()
+    default_log, other_log = os.path.join(tmp_dir, 'default.log'), os.path.join(tmp_dir, 'other.log')
+    num_lines = 20000
+
+    def legacy_log(logger, level, msg, log_to):
+        logger.remove_file_handler()
+        logger.add_file_handler(log_to)
+        logging.Logger.log(logger, level, msg)
+        logger.remove_file_handler()
+        logger.add_file_handler(default_log)
+
+    logger = CustomLogger('bench', log_file=default_log)
+    logger.remove_stream_handler()
+    t0 = perf_counter()
+    for i in range(num_lines):
+        logger.log(logging.INFO, "routed message", log_to=other_log)
+    pooled = num_lines / (perf_counter() - t0)
+
+    logger.removeHandler(logger.routing_handler)
+    logger.add_file_handler(default_log)
+    t0 = perf_counter()
+    for i in range(num_lines):
+        legacy_log(logger, logging.INFO, "routed message", other_log)
+    legacy = num_lines / (perf_counter() - t0)
+    print(f"pooled: {pooled:.0f} lines/s, per-call handlers: {legacy:.0f} lines/s")
 
+    logger = CustomLogger('bench_async', log_file=default_log, async_mode=True)
+    logger.remove_stream_handler()
+    t0 = perf_counter()
+    for i in range(num_lines):
+        logger.log(logging.INFO, "routed message", log_to=other_log)
+    enqueued = num_lines / (perf_counter() - t0)
+    logger.shutdown()
+    print(f"async: {enqueued:.0f} lines/s on the caller thread, {num_lines / (perf_counter() - t0):.0f} lines/s drained")
@@ -0,0 +1,77 @@
+import os
+import re
+import subprocess
+import sys
+
+# Cumulative import time budget (ms) per module. NumPy alone takes ~100-150ms, so the numpy based modules get more
+BUDGETS_MS = {
+    'utils': 400,
+    'sampling': 300,
+    'audio_envelope': 450,
+    'latent_store': 450,
+    'tmp_musika': 450,
+    'custom_logger': 100,
+    'notebook_utils': 100,
+    'youtube_downloader': 100,
+}
+
+# Modules that must only be imported when they are actually used
+HEAVY_MODULES = ('torch', 'tensorflow', 'pydub', 'youtube_dl', 'tqdm', 'musika')
+
+_IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure_import(module, python=sys.executable):
+    """
+    Imports module in a fresh interpreter with -X importtime, run from the repo directory so the repo's
+    modules are found whatever the caller's working directory.
+
+    Returns:
+        cumulative_ms (float): Cumulative import time of the module itself.
+        imported (set): Names of all modules imported on the way.
+    """
+    code = f"import {module}"
+    result = subprocess.run([python, '-X', 'importtime', '-c', code], capture_output=True, text=True, cwd=_REPO_DIR)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    cumulative_ms = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        name = match.group(4)
+        imported.add(name)
+        if name == module and len(match.group(3)) == 1:
+            cumulative_ms = int(match.group(2)) / 1000
+    return cumulative_ms, imported
+
+
+def check_budgets(budgets=BUDGETS_MS, heavy_modules=HEAVY_MODULES, repeats=3):
+    """
+    Checks every module against its budget, using the fastest of repeats runs to reduce noise.
+
+    Returns:
+        violations (list): Human readable description of every violation.
+    """
+    violations = []
+    for module, budget in budgets.items():
+        runs = [measure_import(module) for _ in range(repeats)]
+        cumulative_ms = min(ms for ms, _ in runs)
+        loaded = sorted(name for name in runs[0][1] if name.split('.')[0] in heavy_modules)
+        status = 'ok' if cumulative_ms <= budget and not loaded else 'FAIL'
+        print(f"{module:<20} {cumulative_ms:8.1f}ms / {budget}ms  {status}")
+        if cumulative_ms > budget:
+            violations.append(f"{module} took {cumulative_ms:.1f}ms to import, budget is {budget}ms")
+        if loaded:
+            violations.append(f"{module} imports heavy modules at import time: {', '.join(loaded)}")
+    return violations
+
+
+if __name__ == "__main__":
+    violations = check_budgets()
+    for violation in violations:
+        print(violation)
+    sys.exit(1 if violations else 0)
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from utils import append_npy
+
+
+def file_fingerprint(path):
+    """Fingerprint of a source file from its absolute path, size and mtime."""
+    st = os.stat(path)
+    return hashlib.sha1(f'{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}'.encode()).hexdigest()
+
+
+class LatentStore:
+    """
+    Stores the latents of many audio files in a few large .npy shards, appended along the time axis,
+    with a JSON index of each file's shard, row offset, length and source fingerprint.
+
+    Reads are zero-copy views into np.load(shard, mmap_mode='r'), so training can stream latents straight
+    from disk. A file whose fingerprint is already stored is skipped; if its fingerprint changed, the new
+    latents are appended and the old rows are left unused in their shard.
+
+    Each add appends one line to index.log instead of rewriting the whole index. flush(), or leaving the
+    store as a context manager, compacts the log into index.json; a log left by a crash is replayed on open.
+    """
+    def __init__(self, root, shard_bytes=1 << 30):
+        """
+        Args:
+            root (str): The store directory.
+            shard_bytes (int): Size after which a new shard is started.
+        """
+        self.root = root
+        self.shard_bytes = shard_bytes
+        self.index_path = os.path.join(root, 'index.json')
+        self.log_path = os.path.join(root, 'index.log')
+        os.makedirs(root, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+        else:
+            index = {'files': {}, 'shards': []}
+        self.files = index['files']
+        self.shards = index['shards']
+        self._mmaps = {}
+        self._replay_log()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def __contains__(self, path):
+        return self.is_current(path)
+
+    def __len__(self):
+        return len(self.files)
+
+    def is_current(self, path):
+        """True if the latents of path are stored for its current fingerprint."""
+        entry = self.files.get(os.path.abspath(path))
+        return entry is not None and os.path.exists(path) and entry['fingerprint'] == file_fingerprint(path)
+
+    def missing(self, paths):
+        """Returns the paths whose current latents are not stored, e.g. the files still to encode."""
+        return [path for path in paths if not self.is_current(path)]
+
+    def add(self, path, latent, fingerprint=None):
+        """
+        Appends the latents [time, ...] of the source file at path, unless its fingerprint is already stored.
+
+        Returns:
+            added (bool): False if the file was skipped.
+        """
+        key = os.path.abspath(path)
+        fingerprint = fingerprint or file_fingerprint(path)
+        entry = self.files.get(key)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            return False
+
+        latent = np.asarray(latent)
+        shard = self._shard_for(latent)
+        offset = append_npy(os.path.join(self.root, shard['name']), latent)
+        shard['bytes'] += latent.nbytes
+        self._mmaps.pop(shard['name'], None)
+
+        self.files[key] = {'shard': shard['name'], 'offset': offset, 'length': latent.shape[0],
+                           'fingerprint': fingerprint}
+        with open(self.log_path, 'a') as f:
+            f.write(json.dumps({'path': key, 'entry': self.files[key], 'shard': shard}) + '\n')
+        return True
+
+    def _shard_for(self, latent):
+        signature = [np.lib.format.dtype_to_descr(latent.dtype), list(latent.shape[1:])]
+        for shard in reversed(self.shards):
+            if shard['signature'] == signature and shard['bytes'] + latent.nbytes <= self.shard_bytes:
+                return shard
+        shard = {'name': f'shard_{len(self.shards):05d}.npy', 'signature': signature, 'bytes': 0}
+        self.shards.append(shard)
+        return shard
+
+    def _replay_log(self):
+        if not os.path.exists(self.log_path):
+            return
+        shards = {shard['name']: shard for shard in self.shards}
+        with open(self.log_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # A line cut short by a crash, its rows are left unused in the shard
+                self.files[record['path']] = record['entry']
+                shards[record['shard']['name']] = record['shard']
+        self.shards = list(shards.values())
+        # Compact right away, so new lines are never appended after a cut-off one
+        self.flush()
+
+    def flush(self):
+        """Writes the full index to index.json and clears index.log."""
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': self.files, 'shards': self.shards}, f)
+        os.replace(tmp_path, self.index_path)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    def get(self, path, start=None, stop=None):
+        """
+        Returns a read-only memory-mapped view of the latents of path, optionally only time steps start:stop.
+        """
+        entry = self.files[os.path.abspath(path)]
+        start, stop, _ = slice(start, stop).indices(entry['length'])
+        mmap = self._mmaps.get(entry['shard'])
+        if mmap is None:
+            mmap = self._mmaps[entry['shard']] = np.load(os.path.join(self.root, entry['shard']), mmap_mode='r')
+        return mmap[entry['offset'] + start:entry['offset'] + max(start, stop)]
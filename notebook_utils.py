@@ -1,6 +1,7 @@
 # From https://github.com/yaroslavvb/stuff/blob/master/notebook_util.py
 
-import subprocess, re, os, sys
+import subprocess, os, sys, time, atexit, fcntl
+from typing import NamedTuple, Optional
 
 # GPU picking
 # http://stackoverflow.com/a/41638727/419116
@@ -13,43 +14,74 @@ def run_command(cmd):
     output = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True).communicate()[0]
     return output.decode("ascii")
 
-def list_available_gpus():
-    """Returns list of available GPU ids."""
-    
-    output = run_command("nvidia-smi -L")
-    # lines of the form GPU 0: TITAN X
-    gpu_regex = re.compile(r"GPU (?P<gpu_id>\d+):")
+# GPU inventory from a single machine-readable nvidia-smi query.
+# The command is pluggable (NVIDIA_SMI environment variable or set_smi_command), so a fake script
+# printing the same CSV can stand in for nvidia-smi on machines without GPUs.
+
+class GpuInfo(NamedTuple):
+    # Fields nvidia-smi cannot read ("[N/A]") are None
+    index: int
+    memory_used: Optional[int]  # MiB
+    memory_total: Optional[int]  # MiB
+    utilization: Optional[int]  # percent
+
+    @property
+    def memory_free(self):
+        if self.memory_used is None or self.memory_total is None:
+            return None
+        return self.memory_total - self.memory_used
+
+GPU_QUERY_FIELDS = "index,memory.used,memory.total,utilization.gpu"
+_smi_command = os.environ.get("NVIDIA_SMI", "nvidia-smi")
+_inventory_cache = {"time": None, "gpus": None}
+
+def set_smi_command(cmd):
+    """Sets the nvidia-smi executable (e.g. a fake script for tests) and clears the inventory cache."""
+
+    global _smi_command
+    _smi_command = cmd
+    _inventory_cache["time"] = None
+
+def parse_gpu_query(output):
+    """Parses `nvidia-smi --query-gpu=<GPU_QUERY_FIELDS> --format=csv,noheader,nounits` output."""
+
     result = []
     for line in output.strip().split("\n"):
-        m = gpu_regex.match(line)
-        assert m, "Couldnt parse "+line
-        result.append(int(m.group("gpu_id")))
+        if not line.strip():
+            continue
+        fields = [f.strip() for f in line.split(",")]
+        assert len(fields) == 4, "Couldnt parse "+line
+        # Fields nvidia-smi cannot read are reported as "[N/A]", they must not look like an idle GPU
+        index, used, total, util = [int(f) if f.isdigit() else None for f in fields]
+        result.append(GpuInfo(index, used, total, util))
     return result
 
+def gpu_inventory(ttl=2.0):
+    """Returns a list of GpuInfo, reusing the previous query if it is less than ttl seconds old."""
+
+    now = time.monotonic()
+    if _inventory_cache["time"] is None or now - _inventory_cache["time"] > ttl:
+        output = subprocess.run([_smi_command, "--query-gpu="+GPU_QUERY_FIELDS, "--format=csv,noheader,nounits"],
+                                stdout=subprocess.PIPE, check=True).stdout.decode("ascii")
+        _inventory_cache["gpus"] = parse_gpu_query(output)
+        _inventory_cache["time"] = now
+    return _inventory_cache["gpus"]
+
+def list_available_gpus():
+    """Returns list of available GPU ids."""
+
+    return [gpu.index for gpu in gpu_inventory()]
+
 def gpu_memory_map():
-    """Returns map of GPU id to memory allocated on that GPU."""
-
-    output = run_command("nvidia-smi")
-    gpu_output = output[output.find("GPU Memory"):]
-    # lines of the form
-    # |    0      8734    C   python                                       11705MiB |
-    memory_regex = re.compile(r"[|]\s+?(?P<gpu_id>\d+)\D+?(?P<pid>\d+).+[ ](?P<gpu_memory>\d+)MiB")
-    rows = gpu_output.split("\n")
-    result = {gpu_id: 0 for gpu_id in list_available_gpus()}
-    for row in gpu_output.split("\n"):
-        m = memory_regex.search(row)
-        if not m:
-            continue
-        gpu_id = int(m.group("gpu_id"))
-        gpu_memory = int(m.group("gpu_memory"))
-        result[gpu_id] += gpu_memory
-    return result
+    """Returns map of GPU id to memory allocated on that GPU, None if nvidia-smi cannot read it."""
+
+    return {gpu.index: gpu.memory_used for gpu in gpu_inventory()}
 
 def pick_gpu_lowest_memory():
-    """Returns GPU with the least allocated memory"""
+    """Returns GPU with the least allocated memory, GPUs with unreadable memory come last"""
 
-    memory_gpu_map = [(memory, gpu_id) for (gpu_id, memory) in gpu_memory_map().items()]
-    best_memory, best_gpu = sorted(memory_gpu_map)[0]
+    memory_gpu_map = [(memory is None, memory or 0, gpu_id) for (gpu_id, memory) in gpu_memory_map().items()]
+    _, best_memory, best_gpu = sorted(memory_gpu_map)[0]
     return best_gpu
 
 def setup_one_gpu():
@@ -59,7 +91,151 @@ def setup_one_gpu():
     os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"
     os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
 
+# Multi-job GPU allocation.
+# Each claimed GPU gets a lease file named gpu<id>.<pid>.lease in a shared directory, created under an
+# exclusive flock, so jobs launched together see each other's claims before any memory shows up in nvidia-smi.
+# Leases of dead processes are ignored and cleaned up.
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class GpuAllocator:
+    def __init__(self, lease_dir="/tmp/gpu_leases", inventory=gpu_inventory, slots_per_gpu=1,
+                 memory_weight=1.0, util_weight=1.0):
+        """
+        lease_dir: directory shared by all jobs on the host
+        inventory: callable returning a list of GpuInfo, e.g. a simulated device table in tests
+        slots_per_gpu: number of jobs allowed to hold a lease on one GPU
+        memory_weight, util_weight: weights of the used memory fraction and utilization in the GPU score
+        """
+        self.lease_dir = lease_dir
+        self.inventory = inventory
+        self.slots_per_gpu = slots_per_gpu
+        self.memory_weight = memory_weight
+        self.util_weight = util_weight
+        self.claimed = []
+        os.makedirs(os.path.dirname(os.path.abspath(lease_dir)), exist_ok=True)
+        try:
+            os.mkdir(lease_dir)
+            # Only a directory created here is made world-writable with the sticky bit like /tmp, so jobs of every
+            # user share the leases. A directory passed in keeps its permissions.
+            os.chmod(lease_dir, 0o1777)
+        except FileExistsError:
+            pass
+        atexit.register(self.release)
+
+    def _live_leases(self):
+        """Returns map of GPU id to number of leases held by live processes, removing stale lease files."""
+
+        leases = {}
+        for name in os.listdir(self.lease_dir):
+            if not (name.startswith("gpu") and name.endswith(".lease")):
+                continue
+            try:
+                gpu, pid = map(int, name[len("gpu"):-len(".lease")].split("."))
+            except ValueError:
+                continue  # Not a lease written by GpuAllocator
+            if _pid_alive(pid):
+                leases[gpu] = leases.get(gpu, 0) + 1
+            else:
+                try:
+                    os.remove(os.path.join(self.lease_dir, name))
+                except OSError:
+                    pass  # Already removed, or owned by another user; ignored either way as its process is dead
+        return leases
+
+    def score(self, gpu, num_leases):
+        """
+        Lower is better. Every existing lease counts as a fully loaded GPU worth of memory and utilization.
+        Unreadable memory or utilization counts as fully used.
+        """
+
+        memory = gpu.memory_used / gpu.memory_total if gpu.memory_used is not None and gpu.memory_total else 1.0
+        utilization = gpu.utilization if gpu.utilization is not None else 100
+        load = self.memory_weight * memory + self.util_weight * utilization / 100
+        return load + num_leases * (self.memory_weight + self.util_weight)
+
+    def claim(self, n=1):
+        """Atomically claims the n best scoring GPUs with a free slot, returns their ids."""
+
+        # flock works on a read-only descriptor, so the lock file created by another user (mode 0644 under the
+        # usual umask) can still be opened
+        with os.fdopen(os.open(os.path.join(self.lease_dir, ".lock"), os.O_CREAT | os.O_RDONLY, 0o666)) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            leases = self._live_leases()
+            candidates = sorted((self.score(gpu, leases.get(gpu.index, 0)), gpu.index) for gpu in self.inventory()
+                                if leases.get(gpu.index, 0) < self.slots_per_gpu and gpu.index not in self.claimed)
+            if len(candidates) < n:
+                raise RuntimeError(f"Requested {n} GPUs but only {len(candidates)} have a free slot")
+            gpu_ids = [gpu_id for _, gpu_id in candidates[:n]]
+            for gpu_id in gpu_ids:
+                open(self._lease_path(gpu_id), "w").close()
+            self.claimed.extend(gpu_ids)
+        return gpu_ids
+
+    def release(self):
+        """Releases all GPUs claimed by this allocator."""
+
+        for gpu_id in self.claimed:
+            try:
+                os.remove(self._lease_path(gpu_id))
+            except FileNotFoundError:
+                pass
+        self.claimed = []
+
+    def _lease_path(self, gpu_id):
+        return os.path.join(self.lease_dir, f"gpu{gpu_id}.{os.getpid()}.lease")
+
+def setup_gpus(n=1, allocator=None):
+    """Claims n GPUs for this process and makes only those visible. Returns the allocator holding the leases."""
+
+    assert not 'tensorflow' in sys.modules, "GPU setup must happen before importing TensorFlow"
+    allocator = allocator or GpuAllocator()
+    gpu_ids = allocator.claim(n)
+    print("Picking GPUs "+",".join(map(str, gpu_ids)))
+    os.environ["CUDA_DEVICE_ORDER"]="PCI_BUS_ID"
+    os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(map(str, gpu_ids))
+    return allocator
+
 def setup_no_gpu():
     if 'tensorflow' in sys.modules:
         print("Warning, GPU setup must happen before importing TensorFlow")
-    os.environ["CUDA_VISIBLE_DEVICES"] = ''
\ No newline at end of file
+    os.environ["CUDA_VISIBLE_DEVICES"] = ''
+
+
+if __name__ == "__main__":
+    # Drive the inventory with a fake nvidia-smi, as on a machine without GPUs
+    import tempfile
+
+    fake_smi = os.path.join(tempfile.mkdtemp(), "nvidia-smi")
+    with open(fake_smi, "w") as f:
+        f.write("#!/bin/sh\nprintf '0, 11705, 12288, 97\\n1, 12, 12288, 0\\n2, [N/A], 12288, [N/A]\\n'\n")
+    os.chmod(fake_smi, 0o755)
+    set_smi_command(fake_smi)
+
+    print(gpu_inventory())
+    assert gpu_memory_map() == {0: 11705, 1: 12, 2: None}
+    assert pick_gpu_lowest_memory() == 1
+    assert GpuAllocator(tempfile.mkdtemp()).claim(3)[-1] == 2
+
+    # Eight jobs launched at once spread over a simulated device table instead of piling onto one GPU
+    from multiprocessing import Pool
+
+    lease_dir = tempfile.mkdtemp()
+    table = [GpuInfo(i, 100 * i, 12288, 0) for i in range(8)]
+
+    def claim_one(_):
+        allocator = GpuAllocator(lease_dir, inventory=lambda: table)
+        gpu_ids = allocator.claim(1)
+        # Keep the lease alive until every job has claimed
+        allocator.claimed = []
+        return gpu_ids[0]
+
+    with Pool(8) as pool:
+        assert sorted(pool.map(claim_one, range(8))) == list(range(8))
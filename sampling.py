@@ -0,0 +1,154 @@
+import numpy as np
+
+
+def as_generator(rng=None):
+    """
+    Returns a numpy Generator from a Generator, an integer seed, or None. None draws the seed from the
+    global numpy RandomState, so results stay reproducible under utils.seed_everything.
+    """
+    if isinstance(rng, np.random.Generator):
+        return rng
+    if rng is None:
+        rng = int(np.random.randint(0, 2**63 - 1, dtype=np.int64))
+    return np.random.default_rng(rng)
+
+
+def sample_without_replacement(n, k, rng=None):
+    """
+    Draws k distinct indices from range(n) uniformly at random, in random order, using O(k) memory.
+
+    Indices are drawn in vectorized batches and duplicates are rejected in draw order, which is
+    equivalent to drawing one index at a time and redrawing repeats. When k is more than half of n,
+    a permutation is cheaper and is used instead.
+
+    Args:
+        n (int): Size of the index space.
+        k (int): Number of indices to draw, at most n.
+        rng: Generator, integer seed or None, see as_generator.
+
+    Returns:
+        indices (numpy.ndarray): int64 array of k distinct indices.
+    """
+    assert 0 <= k <= n, f"Cannot draw {k} distinct indices from {n}"
+    rng = as_generator(rng)
+    if 2 * k > n:
+        return rng.permutation(n)[:k]
+
+    selected = np.empty(0, dtype=np.int64)
+    while len(selected) < k:
+        needed = k - len(selected)
+        # Expected number of draws to get 'needed' new indices, plus some slack to avoid extra rounds
+        num_draws = int(needed * n / (n - len(selected))) + 16
+        draws = rng.integers(0, n, size=num_draws, dtype=np.int64)
+        draws = draws[~np.isin(draws, selected)]
+        _, first = np.unique(draws, return_index=True)
+        new = draws[np.sort(first)][:needed]
+        selected = np.concatenate([selected, new])
+    return selected
+
+
+_END = object()
+
+
+def reservoir_sample(iterable, k, rng=None):
+    """
+    Draws k items uniformly at random from an iterable of unknown length in one pass (Algorithm L).
+
+    Args:
+        iterable: Any iterable.
+        k (int): Number of items to keep.
+        rng: Generator, integer seed or None, see as_generator.
+
+    Returns:
+        reservoir (list): k items, or all items if the iterable has fewer than k.
+    """
+    rng = as_generator(rng)
+    it = iter(iterable)
+    reservoir = []
+    for item in it:
+        reservoir.append(item)
+        if len(reservoir) == k:
+            break
+    if len(reservoir) < k or k == 0:
+        return reservoir
+
+    w = np.exp(np.log(rng.random()) / k)
+    while True:
+        # Number of items to skip before the next one enters the reservoir
+        skip = int(np.floor(np.log(rng.random()) / np.log1p(-w)))
+        for _ in range(skip):
+            if next(it, _END) is _END:
+                return reservoir
+        item = next(it, _END)
+        if item is _END:
+            return reservoir
+        reservoir[rng.integers(k)] = item
+        w *= np.exp(np.log(rng.random()) / k)
+
+
+def stratified_sample(labels, num_samples, rng=None):
+    """
+    Draws indices without replacement so that each label keeps its share of the data set.
+    Per-label counts are rounded with the largest remainder method, so they sum to num_samples.
+
+    Args:
+        labels (numpy.ndarray): Label of every item, shape (N,).
+        num_samples (int or float): Number of indices, or a fraction of N if a float.
+        rng: Generator, integer seed or None, see as_generator.
+
+    Returns:
+        indices (numpy.ndarray): int64 array of sorted indices.
+    """
+    rng = as_generator(rng)
+    labels = np.asarray(labels)
+    if isinstance(num_samples, float):
+        num_samples = int(round(num_samples * len(labels)))
+    assert 0 <= num_samples <= len(labels)
+
+    classes, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    quotas = counts * num_samples / len(labels)
+    per_class = np.floor(quotas).astype(np.int64)
+    remainder = num_samples - per_class.sum()
+    per_class[np.argsort(per_class - quotas, kind='stable')[:remainder]] += 1
+
+    order = np.argsort(inverse, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    indices = [order[start + sample_without_replacement(count, k, rng)]
+               for start, count, k in zip(starts, counts, per_class) if k > 0]
+    return np.sort(np.concatenate(indices)) if indices else np.empty(0, dtype=np.int64)
+
+
+def random_subset(dset, num_samples, rng=None, labels=None):
+    """
+    Returns a torch Subset of num_samples distinct items of dset, stratified by labels if given.
+    """
+    from torch.utils.data import Subset
+
+    if labels is not None:
+        indices = stratified_sample(labels, num_samples, rng)
+    else:
+        indices = sample_without_replacement(len(dset), num_samples, rng)
+    return Subset(dset, indices.tolist())
+
+
+if __name__ == "__main__":
+    # Memory and time stay proportional to k, even for a 10^9-sized index space
+    import tracemalloc
+    from time import perf_counter
+
+    for n, k in [(10**9, 10**3), (10**9, 10**6), (10**6, 9 * 10**5)]:
+        tracemalloc.start()
+        t0 = perf_counter()
+        indices = sample_without_replacement(n, k, rng=0)
+        elapsed = perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert len(np.unique(indices)) == k and indices.min() >= 0 and indices.max() < n
+        print(f"n={n:.0e} k={k:.0e}: {elapsed * 1000:.1f}ms, peak {peak / 2**20:.1f}MiB")
+
+    labels = np.repeat([0, 1, 2], [500, 300, 200])
+    indices = stratified_sample(labels, 0.1, rng=0)
+    assert np.array_equal(np.bincount(labels[indices]), [50, 30, 20])
+
+    sample = reservoir_sample(range(10**6), 100, rng=0)
+    assert len(set(sample)) == 100
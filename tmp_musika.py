@@ -1,16 +1,22 @@
 import os
+import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from time import perf_counter
 
 import numpy as np
-import tensorflow as tf
-from pydub import AudioSegment
-from glob import glob
-from tqdm import tqdm
 
-from musika.utils import Utils_functions
+from utils import LazyModule
+
+tf = LazyModule('tensorflow')
+pydub = LazyModule('pydub')
 
 class MusikaEncoderDecoder:
     def __init__(self, args, models_ls):
 
+        from musika.utils import Utils_functions
+
         self.args = args
         self.U = Utils_functions(args)
 
@@ -26,77 +32,158 @@ class MusikaEncoderDecoder:
             self.switch,
         ) = models_ls
 
+        # Inferred from the encoder outputs on the first encode_audio call
+        self.time_compression_ratio = None
+        self.stage1_latent_frames = None
+
+    @staticmethod
+    def _frame(x, width):
+        """Splits [channels, time, depth] into [channels * (time // width), width, depth] chunks, channel-major."""
+        channels, depth = x.shape[0], x.shape[-1]
+        num = x.shape[1] // width
+        return tf.reshape(x[:, : num * width], [channels * num, width, depth])
+
+    @staticmethod
+    def _merge_frames(lat, channels):
+        """
+        Inverse of _frame for encoder outputs: [channels * num, ..., t, depth] -> [channels, ..., num * t, depth],
+        with the same size-1 dimensions squeezed as the former per-channel tf.split/tf.concat/tf.squeeze.
+        """
+        shape = lat.shape.as_list()
+        num = shape[0] // channels
+        lat = tf.reshape(lat, [channels, num] + shape[1:])
+        rank = len(shape) + 1
+        lat = tf.transpose(lat, [0] + list(range(2, rank - 2)) + [1, rank - 2, rank - 1])
+        lat = tf.reshape(lat, [channels] + shape[1:-2] + [num * shape[-2], shape[-1]])
+        squeeze_axes = [i for i in range(1, len(lat.shape)) if lat.shape[i] == 1]
+        return tf.squeeze(lat, squeeze_axes) if squeeze_axes else lat
+
+    @property
+    def window_samples(self):
+        """Samples advanced per encode_stream window; every window fills whole chunks of both encoder stages."""
+        return self.args.hop * self.args.shape * self.args.shape
+
+    @property
+    def min_encode_length(self):
+        """Shortest waveform (in samples) that fills one second-stage chunk, shorter clips are zero-padded to it."""
+        if self.stage1_latent_frames is None:
+            # Encoding one first-stage chunk of silence tells how many latent frames every chunk yields
+            chunk = tf.zeros([self.args.shape * self.args.hop + 3 * self.args.hop, 1], dtype=tf.float32)
+            self.stage1_latent_frames = self.U.distribute_enc(self._spec_chunks(chunk), self.enc).shape[-2]
+        stage1_chunks = -(-self.args.shape // self.stage1_latent_frames)
+        return stage1_chunks * self.args.shape * self.args.hop + 3 * self.args.hop
+
     def encode_audio(self, audio_wf):
-        c = 0
-        time_compression_ratio = 16  # TODO: infer time compression ratio
-        shape2 = self.args.shape
+        return self._trim_padding(self._encode(self._prepare_waveform(audio_wf)), audio_wf.shape[-1])
 
+    def _prepare_waveform(self, audio_wf):
         wv = audio_wf.T  # shape = [samples, channels]
 
-        if (
-            wv.shape[0]
-            > self.args.hop * self.args.shape * 2 + 3 * self.args.hop
-        ):
-
-            rem = (wv.shape[0] - (3 * self.args.hop)) % (
-                self.args.shape * self.args.hop
-            )
-
-            if rem != 0:
-                wv = tf.concat([wv, tf.zeros([rem, 2], dtype=tf.float32)], 0)
-
-            chls = []
-            for channel in range(2):
-
-                x = wv[:, channel]
-                x = tf.expand_dims(
-                    tf.transpose(
-                        self.U.wv2spec(x, hop_size=self.args.hop), (1, 0)
-                    ),
-                    -1,
-                )
-                ds = []
-                num = x.shape[1] // self.args.shape
-                rn = 0
-                for i in range(num):
-                    ds.append(
-                        x[
-                            :,
-                            rn
-                            + (i * self.args.shape) : rn
-                            + (i * self.args.shape)
-                            + self.args.shape,
-                            :,
-                        ]
-                    )
-                del x
-                ds = tf.convert_to_tensor(ds, dtype=tf.float32)
-                lat = self.U.distribute_enc(ds, self.enc)
-                del ds
-                lat = tf.split(lat, lat.shape[0], 0)
-                lat = tf.concat(lat, -2)
-                lat = tf.squeeze(lat)
-
-                ds2 = []
-                num2 = lat.shape[-2] // shape2
-                rn2 = 0
-                for j in range(num2):
-                    ds2.append(
-                        lat[rn2 + (j * shape2) : rn2 + (j * shape2) + shape2, :]
-                    )
-                ds2 = tf.convert_to_tensor(ds2, dtype=tf.float32)
-                lat = self.U.distribute_enc(tf.expand_dims(ds2, -3), self.enc2)
-                del ds2
-                lat = tf.split(lat, lat.shape[0], 0)
-                lat = tf.concat(lat, -2)
-                lat = tf.squeeze(lat)
-                chls.append(lat)
-
-            lat = tf.concat(chls, -1)
-
-            del chls
-            
+        if wv.shape[0] < self.min_encode_length:
+            # Zero-pad clips too short for one second-stage chunk, which used to return None or fail
+            padding = tf.zeros([self.min_encode_length - wv.shape[0], wv.shape[1]], dtype=tf.float32)
+            wv = tf.concat([wv, padding], 0)
+        return wv
+
+    def _trim_padding(self, lat, num_samples):
+        """Drops the latent frames of a zero-padded clip that only cover the padding."""
+        if num_samples >= self.min_encode_length:
             return lat
+        samples_per_frame = self.args.hop * self.time_compression_ratio
+        return lat[:max(1, -(-(num_samples - 3 * self.args.hop) // samples_per_frame))]
+
+    def _encode(self, wv):
+        channels = wv.shape[1]
+        lat = self.U.distribute_enc(self._spec_chunks(wv), self.enc)
+        lat = self.U.distribute_enc(self._latent_chunks(lat, channels), self.enc2)
+        return self._join_latents(lat, channels)
+
+    def _spec_chunks(self, wv):
+        """[samples, channels] waveform -> first-stage encoder input [channels * chunks, bins, shape, 1]."""
+        channels = wv.shape[1]
+
+        rem = (wv.shape[0] - (3 * self.args.hop)) % (
+            self.args.shape * self.args.hop
+        )
+
+        if rem != 0:
+            wv = tf.concat([wv, tf.zeros([rem, channels], dtype=tf.float32)], 0)
+
+        # Both channels go through each encoder stage as one batch
+        x = tf.stack(
+            [self.U.wv2spec(wv[:, channel], hop_size=self.args.hop) for channel in range(channels)]
+        )  # shape = [channels, frames, bins]
+        ds = self._frame(x, self.args.shape)
+        del x
+        return tf.expand_dims(tf.transpose(ds, (0, 2, 1)), -1)
+
+    def _latent_chunks(self, lat, channels):
+        """First-stage encoder output -> second-stage encoder input [channels * chunks2, 1, shape, depth]."""
+        self.stage1_latent_frames = lat.shape[-2]
+        lat = self._merge_frames(lat, channels)
+        return tf.expand_dims(self._frame(lat, self.args.shape), -3)
+
+    def _join_latents(self, lat, channels):
+        """Second-stage encoder output -> [latent frames, channels * latent depth]."""
+        # Spectrogram frames per latent frame, formerly hard-coded as 16
+        self.time_compression_ratio = (self.args.shape // self.stage1_latent_frames) * (self.args.shape // lat.shape[-2])
+        lat = self._merge_frames(lat, channels)
+        return tf.concat(tf.unstack(lat), -1)
+
+    def _stream_windows(self, audio, window_samples):
+        """
+        Yields ([channels, samples] window, is_last) with windows starting every window_samples samples and
+        overlapping by the 3 * hop samples the STFT frames reach past their start.
+        audio is an array-like of shape [channels, samples] (e.g. a memmap) or an iterable of such blocks.
+        """
+        overlap = 3 * self.args.hop
+        size = window_samples + overlap
+        if hasattr(audio, 'shape'):
+            total = audio.shape[-1]
+            for start in range(0, max(total - overlap, 1), window_samples):
+                yield np.asarray(audio[:, start:start + size], dtype=np.float32), start + size >= total
+            return
+
+        buffer = None
+        for block in audio:
+            block = np.asarray(block, dtype=np.float32)
+            buffer = block if buffer is None else np.concatenate([buffer, block], -1)
+            # Keep one full window back, so the last window is always flagged
+            while buffer.shape[-1] > size + window_samples:
+                yield buffer[:, :size], False
+                buffer = buffer[:, window_samples:]
+        while buffer is not None:
+            if buffer.shape[-1] > size:
+                yield buffer[:, :size], False
+                buffer = buffer[:, window_samples:]
+            else:
+                yield buffer, True
+                buffer = None
+
+    def encode_stream(self, audio, windows_per_step=1):
+        """
+        Encodes arbitrarily long audio window by window, yielding [latent frames, latent depth] blocks.
+        The concatenated blocks equal encode_audio on the whole input, and memory is bounded by the window size.
+
+        Args:
+            audio: [channels, samples] array-like (e.g. np.load(..., mmap_mode='r')) or an iterable of blocks.
+            windows_per_step (int): Number of window_samples encoded per encoder call.
+        """
+        first = True
+        for wf, is_last in self._stream_windows(audio, self.window_samples * windows_per_step):
+            if first and is_last:
+                # Audio within one window, including clips short enough to be padded
+                yield self.encode_audio(wf)
+                return
+            if is_last and not first:
+                # A trailing window too short for one second-stage chunk adds nothing to the one-shot result
+                length = wf.shape[-1] - 3 * self.args.hop
+                length += length % (self.args.shape * self.args.hop)  # the padding applied by _encode
+                chunks = length // self.args.hop // self.args.shape
+                if length <= 0 or chunks * self.stage1_latent_frames < self.args.shape:
+                    return
+            yield self._encode(wf.T)
+            first = False
 
     def decode_audio(self, lat):
         lat = tf.expand_dims(lat, 0)
@@ -104,8 +191,295 @@ class MusikaEncoderDecoder:
         wv = self.U.decode_waveform(lat, self.dec, self.dec2)
         return wv.T
 
+    def decode_stream(self, latents, window=256, overlap=32, num_samples=None):
+        """
+        Decodes a stream of latent blocks (e.g. from encode_stream) in windows of 'window' latent frames that
+        overlap by 'overlap' frames, cross-fading the overlaps linearly. Yields [channels, samples] numpy blocks.
+
+        Args:
+            latents: Iterable of [latent frames, latent depth] arrays.
+            window (int): Latent frames per decoder call.
+            overlap (int): Latent frames shared by consecutive windows.
+            num_samples (int): If set, output stops after this many samples, e.g. the length of the encoded audio.
+        """
+        assert 0 <= overlap < window
+
+        def windows():
+            buffer = None
+            decoded = False
+            for lat in latents:
+                lat = np.asarray(lat)
+                buffer = lat if buffer is None else np.concatenate([buffer, lat], 0)
+                while buffer.shape[0] > window:
+                    yield buffer[:window]
+                    decoded = True
+                    buffer = buffer[window - overlap:]
+            # The first 'overlap' frames of the rest were already decoded with the previous window
+            if buffer is not None and (buffer.shape[0] > overlap or not decoded):
+                yield buffer
+
+        emitted = 0
+        tail = None
+        for lat in windows():
+            wv = np.asarray(self.decode_audio(lat))
+            samples_per_frame = wv.shape[-1] // lat.shape[0]
+            if tail is not None:
+                fade = tail.shape[-1]
+                ramp = np.linspace(0.0, 1.0, fade + 2, dtype=wv.dtype)[1:-1]
+                wv = np.concatenate([tail * (1 - ramp) + wv[..., :fade] * ramp, wv[..., fade:]], -1)
+            # Hold back the part the next window overlaps, it is emitted after cross-fading
+            hold = overlap * samples_per_frame
+            out, tail = wv[..., :wv.shape[-1] - hold], wv[..., wv.shape[-1] - hold:]
+            if num_samples is not None:
+                out = out[..., :max(num_samples - emitted, 0)]
+            emitted += out.shape[-1]
+            yield out
+        if tail is not None and tail.shape[-1] > 0:
+            if num_samples is not None:
+                tail = tail[..., :max(num_samples - emitted, 0)]
+            yield tail
+
+class _BatchPacker:
+    """
+    Packs encoder input chunks from many files into fixed-size batches and scatters the outputs back.
+    add() returns the files whose chunks are all encoded, as (key, output chunks in order).
+    """
+    def __init__(self, U, model, batch_size):
+        self.U = U
+        self.model = model
+        self.batch_size = batch_size
+        self.segments = deque()  # (key, chunks) not yet encoded
+        self.pending = 0
+        self.outputs = {}  # key -> [expected chunks, received output parts]
+        self.chunks_encoded = 0
+
+    def add(self, key, chunks):
+        self.outputs[key] = [chunks.shape[0], []]
+        self.segments.append((key, chunks))
+        self.pending += chunks.shape[0]
+        done = []
+        while self.pending >= self.batch_size:
+            done += self._run_batch()
+        return done
+
+    def flush(self):
+        done = []
+        while self.pending > 0:
+            done += self._run_batch()
+        return done
+
+    def _run_batch(self):
+        parts, keys, size = [], [], 0
+        while self.segments and size < self.batch_size:
+            key, chunks = self.segments.popleft()
+            take = min(chunks.shape[0], self.batch_size - size)
+            if take < chunks.shape[0]:
+                self.segments.appendleft((key, chunks[take:]))
+            parts.append(chunks[:take])
+            keys.append((key, take))
+            size += take
+        out = self.U.distribute_enc(tf.concat(parts, 0), self.model)
+        self.pending -= size
+        self.chunks_encoded += size
+
+        done = []
+        offset = 0
+        for key, take in keys:
+            expected, received = self.outputs[key]
+            received.append(out[offset:offset + take])
+            offset += take
+            expected -= take
+            self.outputs[key][0] = expected
+            if expected == 0:
+                del self.outputs[key]
+                done.append((key, tf.concat(received, 0)))
+        return done
+
+
+class CorpusEncoder:
+    """
+    Encodes many files with a MusikaEncoderDecoder, keeping the encoders busy with full batches.
+
+    A thread pool loads files and computes spectrogram chunks ahead of the encoder, bounded to queue_size
+    files in flight. First-stage chunks from different files are packed into batches of batch_size for enc,
+    and once all chunks of a file are encoded its second-stage chunks are packed into batches for enc2.
+    Latents are scattered back to their files and yielded as files complete, not in input order.
+    """
+    def __init__(self, musika, batch_size=32, num_workers=4, queue_size=8, load_fn=None):
+        """
+        Args:
+            musika (MusikaEncoderDecoder): The encoder.
+            batch_size (int): Chunks per encoder call, for both stages.
+            num_workers (int): Threads loading audio and computing spectrograms.
+            queue_size (int): Maximum number of prepared files waiting for the encoder.
+            load_fn: Callable path -> [channels, samples] float32 array, defaults to pydub decoding.
+        """
+        self.musika = musika
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.load_fn = load_fn or self.load_audio
+        self.stats = {}
+
+    def load_audio(self, path):
+        sr = getattr(self.musika.args, 'sr', 44100)
+        seg = pydub.AudioSegment.from_file(path).set_frame_rate(sr).set_channels(2)
+        samples = np.array(seg.get_array_of_samples(), dtype=np.float32).reshape(-1, 2).T
+        return samples / float(1 << (8 * seg.sample_width - 1))
+
+    def _prepare(self, path):
+        audio = np.asarray(self.load_fn(path), dtype=np.float32)
+        wv = self.musika._prepare_waveform(audio)
+        return audio.shape[-1], wv.shape[1], self.musika._spec_chunks(wv)
+
+    def encode_files(self, paths):
+        """
+        Yields (path, latent) for every file, latent as returned by MusikaEncoderDecoder.encode_audio.
+        A path listed more than once is yielded once per listing. Files that fail to load are skipped and reported with their error in stats['failed'].
+        """
+        U, m = self.musika.U, self.musika
+        stage1 = _BatchPacker(U, m.enc, self.batch_size)
+        stage2 = _BatchPacker(U, m.enc2, self.batch_size)
+        # Files are keyed by (input position, path), so a path listed twice is encoded and yielded twice
+        channels, num_samples = {}, {}
+        failed = {}
+        keys = enumerate(paths)
+        t0 = perf_counter()
+        m.min_encode_length  # Probes the encoder once here rather than concurrently in the loader threads
+
+        def finish(key, lat):
+            return key[1], m._trim_padding(m._join_latents(lat, channels.pop(key)), num_samples.pop(key))
+
+        def advance(done1):
+            done2 = []
+            for key, lat in done1:
+                done2 += stage2.add(key, m._latent_chunks(lat, channels[key]))
+            for key, lat in done2:
+                yield finish(key, lat)
+
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            in_flight = {}
+            for key in islice(keys, self.queue_size):
+                in_flight[pool.submit(self._prepare, key[1])] = key
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = in_flight.pop(future)
+                    next_key = next(keys, None)
+                    if next_key is not None:
+                        in_flight[pool.submit(self._prepare, next_key[1])] = next_key
+                    try:
+                        num_samples[key], channels[key], chunks = future.result()
+                    except Exception as e:
+                        failed[key[1]] = repr(e)
+                        print(f'Failed to encode {key[1]}: {failed[key[1]]}')
+                        continue
+                    yield from advance(stage1.add(key, chunks))
+
+        yield from advance(stage1.flush())
+        for key, lat in stage2.flush():
+            yield finish(key, lat)
+
+        elapsed = perf_counter() - t0
+        self.stats = {'chunks': stage1.chunks_encoded, 'chunks2': stage2.chunks_encoded, 'seconds': elapsed,
+                      'chunks_per_sec': stage1.chunks_encoded / elapsed if elapsed > 0 else 0.0, 'failed': failed}
+
+
+# Self-check: encode_audio against the former per-channel loop framing, and encode_stream / CorpusEncoder against
+# encode_audio, with the stand-in encoders of benchmarks.py. Run as: python tmp_musika.py --self-check
+
+def _loop_framing_encode(musika, audio_wf):
+    """encode_audio as it was before batching the channels: per-channel slicing and tf.convert_to_tensor."""
+    args, U = musika.args, musika.U
+    wv = tf.transpose(audio_wf)  # shape = [samples, channels]
+    rem = (wv.shape[0] - (3 * args.hop)) % (args.shape * args.hop)
+    if rem != 0:
+        wv = tf.concat([wv, tf.zeros([rem, 2], dtype=tf.float32)], 0)
+
+    chls = []
+    for channel in range(2):
+        x = tf.expand_dims(tf.transpose(U.wv2spec(wv[:, channel], hop_size=args.hop), (1, 0)), -1)
+        ds = [x[:, i * args.shape:(i + 1) * args.shape, :] for i in range(x.shape[1] // args.shape)]
+        del x
+        lat = U.distribute_enc(tf.convert_to_tensor(ds, dtype=tf.float32), musika.enc)
+        del ds
+        lat = tf.squeeze(tf.concat(tf.split(lat, lat.shape[0], 0), -2))
+
+        ds2 = [lat[j * args.shape:(j + 1) * args.shape, :] for j in range(lat.shape[-2] // args.shape)]
+        lat = U.distribute_enc(tf.expand_dims(tf.convert_to_tensor(ds2, dtype=tf.float32), -3), musika.enc2)
+        del ds2
+        chls.append(tf.squeeze(tf.concat(tf.split(lat, lat.shape[0], 0), -2)))
+    return tf.concat(chls, -1)
+
+
+def _measure_encode(framing, seconds, repeats=3):
+    """Runs in a fresh process, so the peak RSS belongs to this encoding alone. Returns (latent, seconds, MiB)."""
+    import resource
+    from benchmarks import stand_in_musika, synthetic_audio
+
+    musika = stand_in_musika()
+    audio = synthetic_audio(2, int(44100 * seconds))
+    encode = musika.encode_audio if framing == 'batched' else lambda x: _loop_framing_encode(musika, x)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(repeats):
+        t0 = perf_counter()
+        lat = encode(audio)
+        times.append(perf_counter() - t0)
+    peak_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024  # ru_maxrss is in KiB
+    return np.asarray(lat), min(times), peak_growth
+
+
+def _self_check(seconds=120):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from benchmarks import stand_in_musika, synthetic_audio
+
+    results = {}
+    for framing in ('loop', 'batched'):
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results[framing] = pool.submit(_measure_encode, framing, seconds).result()
+        lat, elapsed, peak = results[framing]
+        print(f"encode_audio {framing:<8} {seconds}s stereo: {lat.shape}, {elapsed * 1000:8.1f}ms, "
+              f"peak RSS +{peak:.0f}MiB")
+    np.testing.assert_allclose(results['batched'][0], results['loop'][0], rtol=1e-5, atol=1e-5)
+    print("encode_audio matches the loop framing")
+
+    musika = stand_in_musika()
+    lengths = [0.5, 1.2, 2.5, 7, 30, 100]
+    for length in lengths:
+        audio = synthetic_audio(2, int(44100 * length))
+        expected = np.asarray(musika.encode_audio(audio))
+        streamed = np.concatenate([np.asarray(lat) for lat in musika.encode_stream(audio)], 0)
+        np.testing.assert_array_equal(streamed, expected)
+        blocks = (audio[:, i:i + 44100] for i in range(0, audio.shape[-1], 44100))
+        streamed = np.concatenate([np.asarray(lat) for lat in musika.encode_stream(blocks, windows_per_step=2)], 0)
+        np.testing.assert_array_equal(streamed, expected)
+    print(f"encode_stream matches encode_audio for {lengths}s, from an array and from 1s blocks")
+
+    # A repeated path and a file that fails to load, which must be yielded twice and reported respectively
+    paths = [f'{length}s' for length in lengths] + ['0.5s', 'broken']
+
+    def load(path):
+        if path == 'broken':
+            raise OSError('unreadable')
+        return synthetic_audio(2, int(44100 * float(path[:-1])), seed=len(path))
+    corpus = CorpusEncoder(musika, batch_size=8, num_workers=2, load_fn=load)
+    encoded = list(corpus.encode_files(paths))
+    assert sorted(path for path, _ in encoded) == sorted(paths[:-1]), encoded
+    assert list(corpus.stats['failed']) == ['broken'], corpus.stats
+    for path, lat in encoded:
+        np.testing.assert_array_equal(np.asarray(lat), np.asarray(musika.encode_audio(load(path))))
+    print(f"CorpusEncoder matches encode_audio for {len(encoded)} files, "
+          f"{corpus.stats['chunks_per_sec']:.0f} chunks/s")
+
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ['--self-check']:
+        _self_check()
+        sys.exit(0)
+
+    from tqdm import tqdm
 
     # parse args
     args = parse_args()
@@ -1,94 +1,633 @@
+import array
+import atexit
 import csv
+import functools
+import importlib
+import json
 import os
+import pickle
+import queue
 import random
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from itertools import islice
+from multiprocessing import shared_memory
 from typing import Any
-from time import time
+from time import perf_counter_ns
 import numpy as np
-import torch
+
+from sampling import random_subset, sample_without_replacement
+
+
+class LazyModule:
+    """
+    Stands in for a heavy module and imports it on first attribute access, e.g. torch = LazyModule('torch').
+    Unlike importlib.util.LazyLoader it does not touch sys.modules, so checks such as
+    "'tensorflow' in sys.modules" stay accurate until the module is really used.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return f"<LazyModule '{self._name}' ({'loaded' if self._module is not None else 'not loaded'})>"
+
+
+torch = LazyModule('torch')
+
+
+class _Region:
+    """Count, total and a fixed-size reservoir sample of the durations (ns) of one profiled region."""
+    def __init__(self, reservoir_size, rng):
+        self.count = 0
+        self.total = 0
+        self.reservoir = np.zeros(reservoir_size, dtype=np.int64)
+        self.rng = rng
+
+    def add(self, duration):
+        size = len(self.reservoir)
+        if self.count < size:
+            self.reservoir[self.count] = duration
+        else:
+            # Algorithm R: every duration ends up in the sample with equal probability
+            j = self.rng.randrange(self.count + 1)
+            if j < size:
+                self.reservoir[j] = duration
+        self.count += 1
+        self.total += duration
+
+    def summary(self):
+        sample = self.reservoir[:min(self.count, len(self.reservoir))]
+        p50, p95, p99 = np.percentile(sample, [50, 95, 99]) / 1e6
+        return {'count': self.count, 'total_ms': self.total / 1e6, 'mean_ms': self.total / self.count / 1e6,
+                'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99}
+
+
+class _ProfilerRegion:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        if profiler.cuda_sync:
+            torch.cuda.synchronize()
+        profiler._stack.append(self.name)
+        self.path = '/'.join(profiler._stack)
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        if profiler.cuda_sync:
+            torch.cuda.synchronize()
+        end = perf_counter_ns()
+        profiler._stack.pop()
+        profiler._record(self.path, self.start, end - self.start)
+        return False
+
 
 class Profiler:
-    """From https://github.com/acids-ircam/RAVE/blob/master/rave/model.py"""
-    def __init__(self):
+    """
+    From https://github.com/acids-ircam/RAVE/blob/master/rave/model.py, extended with nestable regions.
+
+    tick(msg) still reports the time between consecutive ticks. In addition, region(name) (a context
+    manager) and profile(name) (a decorator) time nested regions with perf_counter_ns, aggregating count,
+    total and p50/p95/p99 per region path in fixed-size reservoirs, and keep the most recent events for
+    export_chrome_trace. Setting Profiler.enabled = False turns every region and tick into a near no-op.
+    """
+    enabled = True
+    _null_region = nullcontext()
+
+    def __init__(self, max_ticks=10000, reservoir_size=1024, max_events=100000, cuda_sync=False):
+        """
+        Args:
+            max_ticks (int): Number of most recent ticks kept for the report.
+            reservoir_size (int): Number of durations sampled per region for the percentiles.
+            max_events (int): Number of most recent region events kept for the Chrome trace.
+            cuda_sync (bool): If True, calls torch.cuda.synchronize around regions, ignored without CUDA.
+        """
         # Initialize the list of ticks with a single item representing the start time
-        self.ticks = [[time(), None]]
+        self.ticks = deque([[perf_counter_ns(), None]], maxlen=max_ticks)
+        self.reservoir_size = reservoir_size
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.regions = {}
+        self.events = deque(maxlen=max_events)
+        # Private, so sampling never advances the seeded global random stream
+        self._rng = random.Random()
+        # Open regions per thread, so regions on different threads nest independently
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
 
     def tick(self, msg):
         # Mark a specific point in the code for profiling
         # Add a new item to the list of ticks with the current time and the provided message
-        self.ticks.append([time(), msg])
+        if not Profiler.enabled:
+            return
+        now = perf_counter_ns()
+        previous = self.ticks[-1][0]
+        self.ticks.append([now, msg])
+        self._record(msg, previous, now - previous)
+
+    def region(self, name):
+        """Context manager timing the enclosed block as region 'name', nested under any enclosing region."""
+        if not Profiler.enabled:
+            return Profiler._null_region
+        return _ProfilerRegion(self, name)
+
+    def profile(self, name=None):
+        """Decorator timing every call of the function as a region, named after the function by default."""
+        def decorator(fn):
+            region_name = name or fn.__qualname__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not Profiler.enabled:
+                    return fn(*args, **kwargs)
+                with _ProfilerRegion(self, region_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _record(self, path, start, duration):
+        region = self.regions.get(path)
+        if region is None:
+            region = self.regions[path] = _Region(self.reservoir_size, self._rng)
+        region.add(duration)
+        self.events.append((path, start, duration, threading.get_ident()))
+
+    def summary(self):
+        """Returns map of region path to count, total/mean and p50/p95/p99 durations in milliseconds."""
+        return {path: region.summary() for path, region in self.regions.items()}
+
+    def export_chrome_trace(self, path):
+        """Writes the recorded events as Chrome trace-event JSON, viewable in chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        trace = [{'name': name.rsplit('/', 1)[-1], 'cat': name, 'ph': 'X', 'ts': start / 1000, 'dur': duration / 1000,
+                  'pid': pid, 'tid': tid} for name, start, duration, tid in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
 
     def __repr__(self):
         rep = 80 * "=" + "\n"  # Separator line for the report
         for i in range(1, len(self.ticks)):
             msg = self.ticks[i][1]
             ellapsed = self.ticks[i][0] - self.ticks[i - 1][0]
-            rep += msg + f": {ellapsed*1000:.2f}ms\n"  # Append the message and elapsed time to the report
+            rep += msg + f": {ellapsed/1e6:.2f}ms\n"  # Append the message and elapsed time to the report
+        rep += 80 * "=" + "\n"
+        for path, stats in sorted(self.summary().items()):
+            rep += (f"{path}: n={stats['count']} total={stats['total_ms']:.2f}ms p50={stats['p50_ms']:.3f}ms "
+                    f"p95={stats['p95_ms']:.3f}ms p99={stats['p99_ms']:.3f}ms\n")
         rep += 80 * "=" + "\n\n\n"  # Separator line for the end of the report
         return rep
 
 
+HISTORY_DTYPE = np.dtype([('step', np.int64), ('value', np.float64)])
+_NPY_HEADER_SIZE = 128
+
+
+def append_npy(path, array, fsync=True):
+    """
+    Appends an array to a .npy file along its first axis, creating the file if needed.
+    The header is padded to a fixed size so it can be rewritten in place with the new length,
+    and the result stays loadable with np.load(path, mmap_mode='r').
+
+    The rows are written before the header, so a crash in between leaves the file at its previous
+    length with some unused trailing bytes, which the next append overwrites.
+
+    Args:
+        fsync (bool): If True, the rows reach the disk before the header is updated.
+
+    Returns:
+        offset (int): Length of the first axis before appending, i.e. where the new rows start.
+    """
+    array = np.ascontiguousarray(array)
+    _npy_header(array.dtype, (np.iinfo(np.int64).max,) + array.shape[1:])  # Fails before touching the file
+    mode = 'r+b' if os.path.exists(path) else 'w+b'
+    with open(path, mode) as f:
+        length = 0
+        if mode == 'r+b':
+            f.seek(0)
+            np.lib.format.read_magic(f)
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            assert dtype == array.dtype and shape[1:] == array.shape[1:], \
+                f"Cannot append {array.dtype}{array.shape} to {dtype}{shape} in {path}"
+            length = shape[0]
+        else:
+            f.write(_npy_header(array.dtype, (0,) + array.shape[1:]))
+        row_bytes = array.dtype.itemsize * int(np.prod(array.shape[1:]))
+        f.seek(_NPY_HEADER_SIZE + length * row_bytes)
+        f.write(array.tobytes())
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+        f.seek(0)
+        f.write(_npy_header(array.dtype, (length + len(array),) + array.shape[1:]))
+    return length
+
+
+def _npy_header(dtype, shape):
+    """Version 1.0 .npy header padded to _NPY_HEADER_SIZE bytes."""
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape})
+    # ljust never truncates, a longer header would shift the data offset
+    assert len(header) < _NPY_HEADER_SIZE - 10, f"npy header does not fit in {_NPY_HEADER_SIZE} bytes: {header}"
+    header = header.ljust(_NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return np.lib.format.magic(1, 0) + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+class MeterSeries:
+    """
+    Running statistics and history of one Meters variable: mean/variance, min/max, EMA and a fixed-window
+    moving average. update only appends to a short pending list; pending values are folded into the
+    statistics (Chan's parallel update for the variance) and the array.array history in vectorized chunks,
+    once fold_every values are pending or a statistic is read.
+    """
+    def __init__(self, window=100, ema_decay=0.99, keep_history=True, fold_every=256):
+        self.count = 0
+        self._folded = 0
+        self._last = None
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._min = float('inf')
+        self._max = float('-inf')
+        self.ema_decay = ema_decay
+        self._ema = None
+        self._window = deque(maxlen=window)
+        self._window_sum = 0.0
+        self._window_evicted = 0
+        self.keep_history = keep_history
+        self.fold_every = fold_every
+        self._pending_steps = []
+        self._pending_values = []
+        self.clear_history()
+
+    def update(self, value, step=None):
+        """Adds a value at 'step', which defaults to the number of values so far."""
+        count = self.count = self.count + 1
+        self._pending_steps.append(step or count)
+        self._pending_values.append(float(value))
+        if count - self._folded >= self.fold_every:
+            self._fold()
+
+    def _fold(self):
+        if not self._pending_values:
+            return
+        values = np.array(self._pending_values)
+        n = len(values)
+        total = self._folded + n
+        chunk_mean = values.mean()
+        delta = chunk_mean - self._mean
+        self._m2 += ((values - chunk_mean) ** 2).sum() + delta * delta * self._folded * n / total
+        self._mean += delta * n / total
+        self._folded = total
+        self._min = min(self._min, values.min())
+        self._max = max(self._max, values.max())
+        self._last = self._pending_values[-1]
+
+        d = self.ema_decay
+        if self._ema is None:
+            self._ema, values = values[0], values[1:]
+        weights = (1 - d) * d ** np.arange(len(values) - 1, -1, -1)
+        self._ema = d ** len(values) * self._ema + weights @ values
+
+        # Keep the window sum running: add the incoming values and subtract the ones the deque evicts
+        window = self._window
+        incoming = self._pending_values if window.maxlen is None else self._pending_values[-window.maxlen:]
+        evicted = 0 if window.maxlen is None else max(0, len(window) + len(incoming) - window.maxlen)
+        self._window_sum += sum(incoming) - sum(islice(window, evicted))
+        window.extend(incoming)
+        self._window_evicted += evicted
+        if self._window_evicted >= len(window):
+            # Re-sum once per turnover of the window, so rounding errors do not accumulate
+            self._window_sum = sum(window)
+            self._window_evicted = 0
+        if self.keep_history:
+            self._steps.frombytes(np.asarray(self._pending_steps, dtype=np.int64).tobytes())
+            self._values.extend(self._pending_values)
+        self._pending_steps = []
+        self._pending_values = []
+
+    def __len__(self):
+        """Number of values in the history."""
+        return len(self._values) + len(self._pending_values) if self.keep_history else 0
+
+    @property
+    def last(self):
+        return self._pending_values[-1] if self._pending_values else self._last
+
+    @property
+    def mean(self):
+        self._fold()
+        return float(self._mean) if self.count > 0 else None
+
+    @property
+    def var(self):
+        self._fold()
+        return float(self._m2 / (self.count - 1)) if self.count > 1 else None
+
+    @property
+    def std(self):
+        return np.sqrt(self.var) if self.count > 1 else None
+
+    @property
+    def min(self):
+        self._fold()
+        return float(self._min)
+
+    @property
+    def max(self):
+        self._fold()
+        return float(self._max)
+
+    @property
+    def ema(self):
+        self._fold()
+        return None if self._ema is None else float(self._ema)
+
+    @property
+    def window_mean(self):
+        self._fold()
+        return self._window_sum / len(self._window) if self._window else None
+
+    @property
+    def steps(self):
+        # A copy: a view would pin the buffer and make the next append fail
+        self._fold()
+        return np.array(self._steps, dtype=np.int64)
+
+    @property
+    def values(self):
+        self._fold()
+        return np.array(self._values, dtype=np.float64)
+
+    def history_array(self):
+        history = np.empty(len(self), dtype=HISTORY_DTYPE)
+        history['step'] = self.steps
+        history['value'] = self.values
+        return history
+
+    def clear_history(self):
+        self._fold()
+        self._steps = array.array('q')
+        self._values = array.array('d')
+
 
 class Meters:
-    def __init__(self, variable_names=None):
-        self.variables = {}
-        self.history = {}
+    def __init__(self, variable_names=None, window=100, ema_decay=0.99, keep_history=True, export_dir=None,
+                 flush_every=10000, resume=False):
+        """
+        Args:
+            variable_names (list): Names of the variables to register.
+            window (int): Number of recent values in the moving average returned by window_mean.
+            ema_decay (float): Decay of the exponential moving average returned by ema.
+            keep_history (bool): If False, only running statistics are kept and memory stays constant.
+            export_dir (str): If set, history is streamed to export_dir/history_<name>.npy every flush_every
+                values per variable and dropped from memory. Read it back with load_history.
+            flush_every (int): Number of buffered values per variable that triggers a flush.
+            resume (bool): If True, history is appended to files already in export_dir, e.g. when resuming a
+                run. Otherwise they are overwritten, as the CSV export does.
+        """
+        self.window = window
+        self.ema_decay = ema_decay
+        self.keep_history = keep_history
+        self.export_dir = export_dir
+        self.flush_every = flush_every
+        self.resume = resume
+        self._exported = set()  # Variables whose history file belongs to this instance
+        self.series = {}
+        if export_dir is not None:
+            os.makedirs(export_dir, exist_ok=True)
         
         if variable_names is not None:
             for name in variable_names:
                 self.register(name)
 
     def register(self, name):
-        self.variables[name] = []
-        self.history[name] = []
+        self.series[name] = MeterSeries(self.window, self.ema_decay, self.keep_history)
+
+    @property
+    def variables(self):
+        return {name: series.values for name, series in self.series.items()}
+
+    @property
+    def history(self):
+        return {name: list(zip(series.steps.tolist(), series.values.tolist())) for name, series in self.series.items()}
 
     def update(self, data, step=None):
         for name, value in data.items():
-            if name in self.variables:
-                self.variables[name].append(value)
-                self.history[name].append((len(self.variables[name]) if not step else step, value))
+            series = self.series.get(name)
+            if series is not None:
+                series.update(value, step)
+                if self.export_dir is not None and len(series) >= self.flush_every:
+                    self._flush_single(name)
+
+    def flush(self):
+        """Appends the buffered history of every variable to its file in export_dir and drops it from memory."""
+        for name in self.series:
+            self._flush_single(name)
+
+    def _flush_single(self, name):
+        series = self.series[name]
+        if name not in self._exported:
+            self._exported.add(name)
+            if not self.resume and os.path.exists(self._history_path(name)):
+                os.remove(self._history_path(name))
+        if len(series) > 0:
+            append_npy(self._history_path(name), series.history_array())
+            series.clear_history()
 
-    def history(self, name):
-        if name in self.history:
-            return self.history[name]
+    def _history_path(self, name):
+        return os.path.join(self.export_dir, f'history_{name}.npy')
+
+    def load_history(self, name):
+        """Memory-maps the exported history of a variable as a structured array with 'step' and 'value' fields."""
+        self._flush_single(name)
+        return np.load(self._history_path(name), mmap_mode='r')
 
     def mean(self, name):
-        if name in self.variables:
-            values = self.variables[name]
-            if len(values) > 0:
-                return sum(values) / len(values)
+        if name in self.series:
+            return self.series[name].mean
+
+    def std(self, name):
+        if name in self.series:
+            return self.series[name].std
+
+    def min(self, name):
+        if name in self.series and self.series[name].count > 0:
+            return self.series[name].min
+
+    def max(self, name):
+        if name in self.series and self.series[name].count > 0:
+            return self.series[name].max
+
+    def ema(self, name):
+        if name in self.series:
+            return self.series[name].ema
+
+    def window_mean(self, name):
+        if name in self.series:
+            return self.series[name].window_mean
 
     def recent_value(self, name):
-        if name in self.variables:
-            values = self.variables[name]
-            if len(values) > 0:
-                return values[-1]
+        if name in self.series:
+            series = self.series[name]
+            if series.count > 0:
+                return series.last
             else:
                 return 0.0
 
     def clear_history(self, name):
-        if name in self.history:
-            self.history[name] = []
+        if name in self.series:
+            self.series[name].clear_history()
 
     def get_recent_values(self, decimals=4):
         recent_values = {}
-        for name in self.variables:
+        for name in self.series:
             recent_values[name] = np.round(self.recent_value(name), decimals)
         return recent_values
     
     def export_all_history(self):
-        for name in self.variables:
+        if self.export_dir is not None:
+            self.flush()
+            return
+        for name in self.series:
             self._export_single_history(name)
 
     def _export_single_history(self, variable_name):
-        if variable_name in self.variables:
+        if variable_name in self.series:
             filename = f'history_{variable_name}.csv'
             with open(filename, 'w', newline='') as csvfile:
                 writer = csv.writer(csvfile)
                 writer.writerow(['Index', variable_name])
-                hist = self.history[variable_name]
-                for index, value in hist:
+                series = self.series[variable_name]
+                for index, value in zip(series.steps.tolist(), series.values.tolist()):
                     writer.writerow([index, value])
 
+class SharedMeterBuffer:
+    """
+    Collects Meters updates from worker processes (DataLoader workers, process pools) through shared memory.
+    Every worker owns a ring buffer of (variable id, value) records and a write counter that only it advances,
+    so writers need no locks. The parent periodically calls reduce_into to fold new records into a Meters.
+    The buffer pickles by shared memory name, so it can be passed to workers directly.
+    """
+    def __init__(self, variable_names, num_workers, capacity=65536):
+        self.variable_names = list(variable_names)
+        self.num_workers = num_workers
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(create=True, size=8 * num_workers * (1 + 2 * capacity))
+        self.owner = True
+        self._attach()
+        self.write_counts[:] = 0
+        self.read_counts = np.zeros(num_workers, dtype=np.int64)
+        self.dropped = 0
+
+    def _attach(self):
+        self.var_ids = {name: i for i, name in enumerate(self.variable_names)}
+        self.write_counts = np.ndarray((self.num_workers,), dtype=np.int64, buffer=self.shm.buf)
+        self.records = np.ndarray((self.num_workers, self.capacity, 2), dtype=np.float64, buffer=self.shm.buf,
+                                  offset=8 * self.num_workers)
+
+    def __getstate__(self):
+        return {'name': self.shm.name, 'variable_names': self.variable_names, 'num_workers': self.num_workers,
+                'capacity': self.capacity}
+
+    def __setstate__(self, state):
+        self.variable_names = state['variable_names']
+        self.num_workers = state['num_workers']
+        self.capacity = state['capacity']
+        # Processes started by multiprocessing share the parent's resource tracker, which unlinks the block
+        # only if the parent never does
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self._attach()
+
+    def writer(self, worker_id):
+        return SharedMeterWriter(self, worker_id)
+
+    def reduce_into(self, meters, reduction='mean', step=None):
+        """
+        Folds all records written since the last call into 'meters', one update per variable.
+
+        Args:
+            meters (Meters): The parent process Meters.
+            reduction (str): 'mean', 'sum' or 'count' of the new values of each variable.
+            step (int): Step passed on to Meters.update.
+
+        Returns:
+            totals (dict): Map of variable name to (sum, count) of the new values.
+        """
+        assert reduction in ['mean', 'sum', 'count']
+        sums = np.zeros(len(self.variable_names))
+        counts = np.zeros(len(self.variable_names), dtype=np.int64)
+        for worker_id in range(self.num_workers):
+            end = int(self.write_counts[worker_id])
+            start = self.read_counts[worker_id]
+            if end - start > self.capacity:
+                # The writer lapped the reader, the oldest records were overwritten
+                self.dropped += end - start - self.capacity
+                start = end - self.capacity
+            positions = np.arange(start, end) % self.capacity
+            var_ids, values = self.records[worker_id, positions].T
+            sums += np.bincount(var_ids.astype(np.int64), weights=values, minlength=len(sums))
+            counts += np.bincount(var_ids.astype(np.int64), minlength=len(counts))
+            self.read_counts[worker_id] = end
+
+        totals = {}
+        data = {}
+        for name, var_id in self.var_ids.items():
+            if counts[var_id] > 0:
+                totals[name] = (sums[var_id], int(counts[var_id]))
+                data[name] = {'mean': sums[var_id] / counts[var_id], 'sum': sums[var_id],
+                              'count': counts[var_id]}[reduction]
+        meters.update(data, step)
+        return totals
+
+    def close(self):
+        """Closes the shared memory, all SharedMeterWriters of this process must be released first."""
+        self.records = self.write_counts = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedMeterWriter:
+    """Worker side of a SharedMeterBuffer, with the same update signature as Meters."""
+    def __init__(self, buffer, worker_id):
+        self.var_ids = buffer.var_ids
+        self.capacity = buffer.capacity
+        self.worker_id = worker_id
+        self.count = int(buffer.write_counts[worker_id])
+        # Plain memoryview item assignment is several times cheaper than numpy scalar indexing
+        self.write_counts = buffer.shm.buf[:8 * buffer.num_workers].cast('q')
+        offset = 8 * buffer.num_workers + 16 * buffer.capacity * worker_id
+        self.records = buffer.shm.buf[offset:offset + 16 * buffer.capacity].cast('d')
+
+    def update(self, data, step=None):
+        for name, value in data.items():
+            var_id = self.var_ids.get(name)
+            if var_id is not None:
+                pos = 2 * (self.count % self.capacity)
+                self.records[pos] = var_id
+                self.records[pos + 1] = value
+                self.count += 1
+                # Publish the record only after it is fully written
+                self.write_counts[self.worker_id] = self.count
+
+
 class EasyDict(dict):
     """
     Allows you to access and modify dictionary keys using dot notation instead of the usual square bracket notation.
@@ -123,20 +662,141 @@ def num_if_possible(s):
 
     return s
 
-def list_files_deep(dir_path, full_paths=True, filter_ext=None):
-    all_files = []
-    for (dirpath, dirnames, filenames) in os.walk(os.path.join(dir_path, '')):
-        if len(filenames) > 0:
-            for f in filenames:
-                if full_paths:
-                    all_files.append(os.path.join(dirpath, f))
+def _scan_dir(dir_path, with_stat=False):
+    """
+    Returns ([(path, name, size, mtime_ns)] of files, [paths of subdirectories]) of one directory, like os.walk.
+    Without with_stat, files are not stat-ed and size and mtime_ns are None.
+    """
+    files, subdirs = [], []
+    try:
+        entries = os.scandir(dir_path)
+    except OSError:
+        return files, subdirs
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    # Like os.walk, symlinked directories are listed but not followed
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+                if with_stat:
+                    st = entry.stat()
+                    files.append((entry.path, entry.name, st.st_size, st.st_mtime_ns))
                 else:
-                    all_files.append(f)
+                    files.append((entry.path, entry.name, None, None))
+            except OSError:
+                continue
+    return files, subdirs
+
+
+def _normalize_ext(filter_ext):
+    if filter_ext is None:
+        return None
+    return (filter_ext,) if isinstance(filter_ext, str) else tuple(filter_ext)
+
+
+def iter_files_deep(dir_path, full_paths=True, filter_ext=None, num_threads=None):
+    """
+    Yields the files under dir_path, filtering extensions while walking.
+
+    Args:
+        dir_path (str): The root directory.
+        full_paths (bool): If True, yields paths, otherwise file names.
+        filter_ext (str or list): Extension(s) to keep, e.g. ['.wav', '.mp3'].
+        num_threads (int): If set, directories are scanned concurrently on a thread pool, which helps on
+            network filesystems. The order of the files is then not deterministic.
+    """
+    filter_ext = _normalize_ext(filter_ext)
+    root = os.path.join(dir_path, '')
+
+    def select(files):
+        for path, name, _, _ in files:
+            if filter_ext is None or name.endswith(filter_ext):
+                yield path if full_paths else name
+
+    if not num_threads:
+        stack = [root]
+        while stack:
+            files, subdirs = _scan_dir(stack.pop())
+            yield from select(files)
+            stack.extend(reversed(subdirs))
+        return
+
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending = {pool.submit(_scan_dir, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                pending.update(pool.submit(_scan_dir, d) for d in subdirs)
+                yield from select(files)
 
-    if filter_ext is not None:
-        return [f for f in all_files if os.path.splitext(f)[1] in filter_ext]
-    else:
-        return all_files
+
+def list_files_deep(dir_path, full_paths=True, filter_ext=None, num_threads=None):
+    return list(iter_files_deep(dir_path, full_paths, filter_ext, num_threads))
+
+
+class FileIndex:
+    """
+    Persistent index of the files (path, size, mtime) under a root directory, stored with pickle.
+    refresh() rescans only directories whose mtime changed since the last run; the listing of any other
+    directory, including the sizes and mtimes of its files, is reused from the index.
+    """
+    def __init__(self, root, index_path):
+        self.root = os.path.join(root, '')
+        self.index_path = index_path
+        # Map of directory path to (directory mtime_ns, files, subdirectories)
+        self.dirs = {}
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                index = pickle.load(f)
+            if index['root'] == self.root:
+                self.dirs = index['dirs']
+
+    def refresh(self, num_threads=None):
+        """Brings the index up to date and saves it. Returns the number of rescanned directories."""
+        def visit(dir_path):
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                return dir_path, None, False
+            cached = self.dirs.get(dir_path)
+            if cached is not None and cached[0] == mtime:
+                return dir_path, cached, False
+            files, subdirs = _scan_dir(dir_path, with_stat=True)
+            return dir_path, (mtime, files, subdirs), True
+
+        dirs = {}
+        rescanned = 0
+        with ThreadPoolExecutor(num_threads or 1) as pool:
+            pending = {pool.submit(visit, self.root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path, entry, scanned = future.result()
+                    if entry is None:
+                        continue
+                    dirs[dir_path] = entry
+                    rescanned += scanned
+                    pending.update(pool.submit(visit, d) for d in entry[2])
+        self.dirs = dirs
+        self.save()
+        return rescanned
+
+    def save(self):
+        tmp_path = self.index_path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'root': self.root, 'dirs': self.dirs}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    def files(self, filter_ext=None):
+        """Yields (path, size, mtime_ns) of the indexed files with the given extension(s)."""
+        filter_ext = _normalize_ext(filter_ext)
+        for _, files, _ in self.dirs.values():
+            for path, name, size, mtime in files:
+                if filter_ext is None or name.endswith(filter_ext):
+                    yield path, size, mtime
 
 
 def inf(dl):
@@ -145,31 +805,319 @@ def inf(dl):
         for x in iter(dl): yield x
 
 
-def choose_rand_index(arr, num_samples):
-    return np.random.choice(arr.shape[0], num_samples, replace=False)
+def _pin(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_pin(x) for x in batch)
+    if isinstance(batch, dict):
+        return {k: _pin(v) for k, v in batch.items()}
+    return batch
+
+
+class PrefetchInfiniteLoader:
+    """
+    Infinite dataloader that keeps a bounded queue of batches filled from a background thread.
+    The next epoch's iterator is created 'lookahead' batches before the current one runs out (for loaders
+    with a length), so DataLoader workers for the next epoch start while the current epoch is still consumed.
+    Loaders with persistent_workers reuse and reset one iterator, so they get no lookahead.
+
+    stats() reports queue depth and the time the consumer spent waiting for batches; a large wait time
+    means the input pipeline is the bottleneck.
+    """
+    def __init__(self, dl, queue_size=8, lookahead=None, pin_memory=False):
+        """
+        Args:
+            dl: Any re-iterable, typically a torch DataLoader.
+            queue_size (int): Maximum number of prefetched batches.
+            lookahead (int): Number of batches before the end of an epoch at which the next epoch's iterator
+                is created, defaults to queue_size. Ignored if dl has no length.
+            pin_memory (bool): If True and CUDA is available, tensors are copied to pinned memory in the
+                background thread.
+        """
+        self.dl = dl
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lookahead = queue_size if lookahead is None else lookahead
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.batches = 0
+        self.epochs = 0
+        self.wait_time = 0.0
+        self._error = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            length = len(self.dl)
+        except TypeError:
+            length = None
+        if getattr(self.dl, 'persistent_workers', False):
+            # iter() would reset the iterator of the running epoch and drop its remaining batches
+            length = None
+        try:
+            it = iter(self.dl)
+            while not self._stop.is_set():
+                next_it = None
+                for i, batch in enumerate(it):
+                    if next_it is None and length is not None and i >= length - 1 - self.lookahead:
+                        next_it = iter(self.dl)
+                        if next_it is it:
+                            next_it = None
+                            length = None
+                    if self.pin_memory:
+                        batch = _pin(batch)
+                    if not self._put((batch, None)):
+                        return
+                self.epochs += 1
+                it = next_it if next_it is not None else iter(self.dl)
+        except Exception as e:
+            self._put((None, e))
+
+    def __iter__(self):
+        return self
 
+    def __next__(self):
+        """Raises the producer's error again on every call after it failed, and StopIteration once closed."""
+        if self._error is not None:
+            raise self._error
+        t0 = perf_counter_ns()
+        while True:
+            if self._stop.is_set():
+                raise StopIteration
+            try:
+                batch, error = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if not self._thread.is_alive() and self.queue.empty():
+                    raise RuntimeError("PrefetchInfiniteLoader's producer thread exited unexpectedly")
+        self.wait_time += (perf_counter_ns() - t0) / 1e9
+        if error is not None:
+            self._error = error
+            raise error
+        self.batches += 1
+        return batch
 
-def seed_everything(seed: int):
+    def stats(self):
+        return {'queue_depth': self.queue.qsize(), 'batches': self.batches, 'epochs': self.epochs,
+                'wait_time': self.wait_time,
+                'mean_wait_ms': self.wait_time / self.batches * 1000 if self.batches else 0.0}
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def choose_rand_index(arr, num_samples, rng=None):
+    return sample_without_replacement(arr.shape[0], num_samples, rng)
+
+
+def seed_everything(seed: int, profile='reproducible', strict=False):
+    """
+    Seeds the global python, numpy and torch generators and sets the cuDNN/torch determinism flags.
+
+    Args:
+        seed (int): The seed.
+        profile (str): 'reproducible' selects deterministic kernels where they exist (possibly slower),
+            'fast' lets cuDNN benchmark and pick the fastest, possibly non-deterministic, kernels.
+        strict (bool): With 'reproducible', ops that have no deterministic implementation raise a
+            RuntimeError. By default they only warn, so results are bit-reproducible only if no such
+            warning appears.
+    """
+    assert profile in ['reproducible', 'fast']
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = True
+    torch.cuda.manual_seed_all(seed)
+    reproducible = profile == 'reproducible'
+    if reproducible:
+        # Required by deterministic cuBLAS on CUDA >= 10.2
+        os.environ.setdefault('CUBLAS_WORKSPACE_CONFIG', ':4096:8')
+    torch.backends.cudnn.deterministic = reproducible
+    torch.backends.cudnn.benchmark = not reproducible
+    torch.use_deterministic_algorithms(reproducible, warn_only=not strict)
+
+
+class RngStreams:
+    """
+    Independent, reproducible random streams derived from one seed. Each stream is identified by a key of
+    integers, e.g. (epoch, sample_index) or (worker_id,), and is seeded from
+    numpy.random.SeedSequence(seed, spawn_key=key): numpy streams are counter-based Philox generators,
+    torch and python streams are Mersenne Twister generators seeded from the same SeedSequence. A stream
+    only depends on the seed and its key, so results do not change with the number of workers or the order
+    in which they run.
+    """
+    def __init__(self, seed):
+        self.seed = seed
+
+    def seed_sequence(self, *key):
+        return np.random.SeedSequence(self.seed, spawn_key=tuple(int(k) for k in key))
+
+    def numpy(self, *key):
+        return np.random.Generator(np.random.Philox(self.seed_sequence(*key)))
+
+    def torch(self, *key):
+        return torch.Generator().manual_seed(self._int_seed(*key))
+
+    def python(self, *key):
+        return random.Random(self._int_seed(*key))
+
+    def seed_globals(self, *key):
+        """Seeds the global python, numpy and torch generators of this process from the stream 'key'."""
+        random.seed(self._int_seed(*key))
+        np.random.seed(self.seed_sequence(*key).generate_state(4))
+        torch.manual_seed(self._int_seed(*key))
+
+    def _int_seed(self, *key):
+        return int(self.seed_sequence(*key).generate_state(1, np.uint64)[0] >> np.uint64(1))
+
+
+def worker_init_fn(worker_id):
+    """
+    DataLoader worker_init_fn giving every worker of every epoch its own python, numpy and torch streams.
+    torch derives each worker's seed from the loader's generator, so runs are reproducible when the
+    DataLoader gets a seeded generator, see seeded_dataloader_kwargs.
+    """
+    RngStreams(torch.utils.data.get_worker_info().seed).seed_globals(worker_id)
+
 
+def seeded_dataloader_kwargs(seed):
+    """Returns the DataLoader keyword arguments for reproducible multi-worker loading."""
+    return {'worker_init_fn': worker_init_fn, 'generator': torch.Generator().manual_seed(seed)}
 
-def pytorch_random_sampler(dset, num_samples):
+
+def pytorch_random_sampler(dset, num_samples, rng=None, labels=None):
     assert num_samples < len(dset)
-    sample_indices = np.random.choice(len(dset), num_samples)
-    return Subset(dset, sample_indices)
+    return random_subset(dset, num_samples, rng, labels)
+
+
+def atomic_torch_save(obj, path):
+    """torch.save to a temporary file in the same directory, then os.replace, so path is never half-written."""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def snapshot_state_dict(state_dict):
+    """Copies a state dict to CPU once, so training can keep updating the live tensors."""
+    snapshot = {}
+    for name, value in state_dict.items():
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            # .to('cpu') already copies device tensors, only CPU tensors need an explicit clone
+            value = value.clone() if value.device.type == 'cpu' else value.to('cpu')
+        snapshot[name] = value
+    return snapshot
+
+
+def retain_top_k(saved, path, metric, keep_top_k, condition):
+    """Adds (metric, path) to saved, deletes the checkpoint files beyond the best keep_top_k, returns the rest."""
+    saved = [(m, p) for m, p in saved if p != path] + [(metric, path)]
+    saved.sort(key=lambda item: item[0], reverse=condition == 'maximize')
+    for _, old_path in saved[keep_top_k:]:
+        if os.path.exists(old_path):
+            os.remove(old_path)
+    return saved[:keep_top_k]
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints on a background thread with atomic writes. A submitted checkpoint that has not started
+    writing when a newer one arrives is dropped. The keep_top_k best checkpoints by metric are kept on disk
+    and older, worse ones are deleted. Pending checkpoints are also written at interpreter exit if close()
+    was never called.
+    """
+    def __init__(self, keep_top_k=1, condition='minimize'):
+        assert condition in ['maximize', 'minimize']
+        self.keep_top_k = keep_top_k
+        self.condition = condition
+        self.saved = []  # (metric, path) of the checkpoints on disk, best first
+        self.coalesced = 0
+        self.error = None
+        self._pending = None
+        self._busy = False
+        self._closed = False
+        self._last_path = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        # The daemon thread would otherwise be killed mid-write at exit, losing the newest checkpoint
+        atexit.register(self.close)
+
+    def submit(self, state_dict, path, metric):
+        """Snapshots state_dict on the calling thread and queues it to be written to path."""
+        snapshot = snapshot_state_dict(state_dict)
+        with self._cond:
+            if self.error is not None:
+                raise self.error
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = (snapshot, path, metric)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                (snapshot, path, metric), self._pending = self._pending, None
+                self._busy = True
+                self._last_path = path
+            try:
+                atomic_torch_save(snapshot, path)
+                self.saved = retain_top_k(self.saved, path, metric, self.keep_top_k, self.condition)
+            except Exception as e:
+                self.error = e
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def flush(self):
+        """Blocks until every submitted checkpoint is written."""
+        with self._cond:
+            while self._pending is not None or self._busy:
+                self._cond.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        atexit.unregister(self.close)
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+            self._thread.join()
+            # A temporary file left by a write that failed half-way
+            for _, path in self.saved + ([(None, self._last_path)] if self._last_path else []):
+                tmp_path = f'{path}.{os.getpid()}.{self._thread.ident}.tmp'
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
 
 
 class EarlyStopping:
     """Early stops the training if validation loss doesn't improve after a given patience."""
 
     def __init__(self, patience=7, verbose=False, delta=0, save_dir='.', saved_model_name="model_chkpt",
-                 condition='minimize'):
+                 condition='minimize', async_save=False, keep_top_k=1):
         """
         Args:
             patience (int): How long to wait after last time validation loss improved.
@@ -178,6 +1126,11 @@ class EarlyStopping:
                             Default: False
             delta (float): Minimum change in the monitored quantity to qualify as an improvement.
                             Default: 0
+            async_save (bool): If True, checkpoints are written on a background thread, call close() at the end.
+                            Default: False
+            keep_top_k (int): Number of best checkpoints kept on disk. With 1, the checkpoint is always
+                            written to save_path, otherwise the metric is added to the file name.
+                            Default: 1
         """
         self.patience = patience
         self.verbose = verbose
@@ -192,7 +1145,10 @@ class EarlyStopping:
         self.save_path = os.path.join(self.save_dir, self.saved_model_name + '.pt')
         self.condition = condition
         assert condition in ['maximize', 'minimize']
-        self.metric_best = np.Inf if condition == 'minimize' else -np.Inf
+        self.metric_best = np.inf if condition == 'minimize' else -np.inf
+        self.keep_top_k = keep_top_k
+        self.writer = CheckpointWriter(keep_top_k, condition) if async_save else None
+        self.saved = []
 
     def __call__(self, metric, model):
 
@@ -216,5 +1172,17 @@ class EarlyStopping:
         if self.verbose:
             print(
                 f'Metric improved ({self.condition}) ({self.metric_best:.6f} --> {metric:.6f}).  Saving model to {os.path.join(self.save_dir, self.saved_model_name + ".pt")}')
-        torch.save(model.state_dict(), self.save_path)
+        path = self.save_path
+        if self.keep_top_k > 1:
+            path = os.path.join(self.save_dir, f'{self.saved_model_name}_{metric:.6f}.pt')
+        if self.writer is not None:
+            self.writer.submit(model.state_dict(), path, metric)
+        else:
+            atomic_torch_save(model.state_dict(), path)
+            self.saved = retain_top_k(self.saved, path, metric, self.keep_top_k, self.condition)
         self.metric_best = metric
+
+    def close(self):
+        """Waits for pending asynchronous checkpoints to be written."""
+        if self.writer is not None:
+            self.writer.close()
@@ -1,6 +1,10 @@
-import youtube_dl
 import csv
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 
 class YouTubeDL:
     def __init__(self, out_dir):
@@ -17,6 +21,7 @@ class YouTubeDL:
             ],
 
         }
+        self.ydl = None
 
     def __call__(self, p):
         """p (pointer) can be link or id"""
@@ -24,12 +29,11 @@ class YouTubeDL:
             ytid = p.split('/')[-1]
         else:
             ytid = p
-        with youtube_dl.YoutubeDL(self.ydl_opts) as ydl:
-            ydl.download([f'http://www.youtube.com/watch?v={ytid}'])
-
-
-ytd = YouTubeDL(out_dir='/home/shreyan/Downloads/pitchfork_audio')
-# ytd('https://www.youtube.com/embed/ZUTu65AXrJw')
+        if self.ydl is None:
+            # Created once and reused for every download of this instance
+            import youtube_dl
+            self.ydl = youtube_dl.YoutubeDL(self.ydl_opts)
+        self.ydl.download([f'http://www.youtube.com/watch?v={ytid}'])
 
 
 def validate_yt_id(sid):
@@ -49,24 +53,120 @@ def validate_yt_id(sid):
         return False
 
 
-yt_ids = []
-failed_ids = []
-with open('yt_links.csv', newline='') as csvfile:
-    cr = csv.reader(csvfile)
-    for row in cr:
-        yid = validate_yt_id(row[1])
-        if yid is not False:
-            if not os.path.exists(f'/home/shreyan/Downloads/pitchfork_audio/{yid}.mp3'):
-                try:
-                    ytd(yid)
-                except:
-                    print(f"Failed to download {row[0]}, {yid}")
-                    failed_ids.append(yid)
+def read_links(csv_path):
+    """Returns [(name, youtube id)] from a (name, link) CSV, with invalid links reported and duplicates dropped."""
+    links = []
+    seen = set()
+    with open(csv_path, newline='') as csvfile:
+        cr = csv.reader(csvfile)
+        for row in cr:
+            yid = validate_yt_id(row[1])
+            if yid is not False:
+                if yid not in seen:
+                    seen.add(yid)
+                    links.append((row[0], yid))
             else:
-                print(yid, 'exists')
-        else:
-            if len(row[1]) > 0:
-                print(row[0], row[1])
+                if len(row[1]) > 0:
+                    print(row[0], row[1])
+    return links
+
+
+class DownloadManager:
+    """
+    Downloads YouTube audio on a bounded pool of worker threads, each reusing one downloader backend.
+    Failed downloads are retried with exponential backoff. Done and failed ids are recorded in a JSON manifest
+    after every download, so a restarted run only redoes the remaining work.
+    """
+    def __init__(self, out_dir, backend_factory=None, num_workers=4, max_retries=3, backoff=2.0,
+                 manifest_path=None, ext='.mp3'):
+        """
+        Args:
+            out_dir (str): Directory the audio files are written to.
+            backend_factory: Callable out_dir -> downloader called with a youtube id, defaults to YouTubeDL.
+                A local fake can be passed to run offline.
+            num_workers (int): Number of concurrent downloads.
+            max_retries (int): Number of retries after a failed attempt.
+            backoff (float): Delay in seconds before the first retry, doubled for every further retry.
+            manifest_path (str): JSON manifest, defaults to out_dir/download_manifest.json.
+            ext (str): Extension of the downloaded files, used to find ids that are already in out_dir.
+        """
+        self.out_dir = out_dir
+        self.backend_factory = backend_factory or YouTubeDL
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.manifest_path = manifest_path or os.path.join(out_dir, 'download_manifest.json')
+        self.ext = ext
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.manifest = {'done': [], 'failed': {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def existing_ids(self):
+        """Ids already downloaded, from one listing of out_dir plus the manifest."""
+        ids = {name[:-len(self.ext)] for name in os.listdir(self.out_dir) if name.endswith(self.ext)}
+        return ids | set(self.manifest['done'])
+
+    def _backend(self):
+        if not hasattr(self._local, 'backend'):
+            self._local.backend = self.backend_factory(self.out_dir)
+        return self._local.backend
+
+    def _download(self, name, yid):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._backend()(yid)
+                self._record(yid, None)
+                return yid, None
+            except Exception as e:
+                error = repr(e)
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff * 2 ** attempt)
+        print(f"Failed to download {name}, {yid}: {error}")
+        self._record(yid, error)
+        return yid, error
+
+    def _record(self, yid, error):
+        with self._lock:
+            if error is None:
+                self.manifest['done'].append(yid)
+                self.manifest['failed'].pop(yid, None)
+            else:
+                self.manifest['failed'][yid] = error
+            tmp_path = f'{self.manifest_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+
+    def download(self, links, retry_failed=True):
+        """
+        Downloads every (name, youtube id) not downloaded yet.
+
+        Args:
+            links (list): (name, youtube id) pairs, e.g. from read_links.
+            retry_failed (bool): If False, ids that failed in a previous run are skipped.
+
+        Returns:
+            failed_ids (list): Ids that failed after all retries.
+        """
+        existing = self.existing_ids()
+        todo = [(name, yid) for name, yid in links if yid not in existing
+                and (retry_failed or yid not in self.manifest['failed'])]
+        print(f'{len(links) - len(todo)} of {len(links)} ids already done or skipped')
+        with ThreadPoolExecutor(self.num_workers) as pool:
+            results = list(pool.map(lambda link: self._download(*link), todo))
+        return [yid for yid, error in results if error is not None]
+
+
+def main(csv_path='yt_links.csv', out_dir='/home/shreyan/Downloads/pitchfork_audio', num_workers=4):
+    manager = DownloadManager(out_dir, num_workers=num_workers)
+    failed_ids = manager.download(read_links(csv_path))
+    print(failed_ids)
 
-print(failed_ids)
 
+if __name__ == "__main__":
+    main()